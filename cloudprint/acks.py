@@ -0,0 +1,197 @@
+# Copyright 2014 Jason Michalski <armooo@armooo.net>
+#
+# This file is part of cloudprint.
+#
+# cloudprint is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cloudprint is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cloudprint.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import concurrent.futures
+import json
+import logging
+import os
+import stat
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+
+from cloudprint import retry
+
+LOGGER = logging.getLogger('cloudprint.acks')
+
+
+class AckQueue(object):
+    """A durable queue of job status updates waiting to be sent.
+
+    put() only records the status, in memory and in the JSON file at path,
+    so a job is done as soon as CUPS has it. A background thread sends the
+    queued statuses with send(job_id, status), up to workers at once, and
+    retries the ones which fail with a transient error after a backoff.
+    Statuses still queued when we stop are sent after the next start.
+    """
+
+    def __init__(self, path, send, workers=4, backoff=None):
+        self.path = path
+        self._send = send
+        self._workers = workers
+        if backoff is None:
+            backoff = retry.Backoff(1.0, 300.0)
+        self._backoff = backoff
+        self._pending = OrderedDict(self._load())
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._thread = None
+
+    def __contains__(self, job_id):
+        with self._lock:
+            return job_id in self._pending
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def put(self, job_id, status):
+        """Queue status to be sent for job_id, replacing any status still
+        queued for it"""
+        with self._changed:
+            self._pending.pop(job_id, None)
+            self._pending[job_id] = status
+            self._save()
+            self._changed.notify_all()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run,
+            name='cloudprint-acks',
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wait(self, timeout=None):
+        """Wait until the queue is empty.
+        returns False if the timeout expired first"""
+        with self._changed:
+            return self._wait_for(lambda: not self._pending, timeout)
+
+    def flush(self):
+        """Send everything queued so far.
+        returns True if nothing failed"""
+        with self._lock:
+            batch = list(self._pending.items())
+        if not batch:
+            return True
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(self._workers, len(batch)),
+        ) as pool:
+            futures = [
+                (job_id, status, pool.submit(self._send, job_id, status))
+                for job_id, status in batch
+            ]
+
+        ok = True
+        with self._changed:
+            for job_id, status, future in futures:
+                error = future.exception()
+                if error is not None and retry.is_transient(error):
+                    LOGGER.warning('Unable to send status %s of job %s: %s' %
+                                   (status, job_id, error))
+                    ok = False
+                    continue
+                if error is not None:
+                    LOGGER.error('Giving up on status %s of job %s: %s' %
+                                 (status, job_id, error))
+                # A newer status may have been queued while this one was sent
+                if self._pending.get(job_id) == status:
+                    del self._pending[job_id]
+            self._save()
+            self._changed.notify_all()
+        return ok
+
+    def _run(self):
+        while True:
+            with self._changed:
+                self._wait_for(lambda: self._pending)
+            try:
+                ok = self.flush()
+            except Exception:
+                LOGGER.exception('Unable to send job statuses')
+                ok = False
+            if ok:
+                self._backoff.reset()
+            else:
+                delay = self._backoff.next()
+                LOGGER.info('Will retry job statuses in %.1f Seconds' % delay)
+                time.sleep(delay)
+
+    def _wait_for(self, predicate, timeout=None):
+        # Condition.wait_for is not available before python 3.2. Must be
+        # called with self._lock held.
+        if timeout is not None:
+            end = time.time() + timeout
+        while not predicate():
+            if timeout is None:
+                self._changed.wait()
+            else:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return False
+                self._changed.wait(remaining)
+        return True
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return [tuple(entry) for entry in json.load(f)]
+        except (IOError, OSError):
+            return []
+        except ValueError:
+            LOGGER.exception('Ignoring unreadable job statuses in ' +
+                             self.path)
+            return []
+
+    def _save(self):
+        # Must be called with self._lock held. The file is replaced
+        # atomically, so a crash leaves either the old or the new queue. If
+        # it can't be written, the statuses are still sent from memory, just
+        # not after a restart.
+        try:
+            self._write()
+        except (IOError, OSError):
+            LOGGER.exception('Unable to save job statuses to ' + self.path)
+
+    def _write(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.cloudprint')
+        try:
+            f = os.fdopen(fd, 'w')
+        except Exception:
+            # the file object never took over fd
+            os.close(fd)
+            os.unlink(tmp_path)
+            raise
+        try:
+            with f:
+                os.chmod(tmp_path, stat.S_IRUSR | stat.S_IWUSR)
+                json.dump(list(self._pending.items()), f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
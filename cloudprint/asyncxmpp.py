@@ -0,0 +1,282 @@
+# Copyright 2014 Jason Michalski <armooo@armooo.net>
+#
+# This file is part of cloudprint.
+#
+# cloudprint is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cloudprint is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cloudprint.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import asyncio
+import logging
+import threading
+import time
+
+from xml.etree.ElementTree import XMLParser
+
+from cloudprint import xmpp
+
+LOGGER = logging.getLogger('cloudprint.asyncxmpp')
+
+
+class AsyncXmppConnection(object):
+    """An asyncio implementation of the XMPP client in XmppConnection.
+
+    Once connected, stanzas are read and keepalives are sent by tasks on the
+    event loop, so they carry on while other work runs on the same loop.
+    """
+
+    def __init__(self, keepalive_period=60.0, ssl_context=None,
+                 ping_period=xmpp.PING_PERIOD,
+                 ping_timeout=xmpp.PING_TIMEOUT):
+        self._keepalive_period = keepalive_period
+        self._ssl_context = ssl_context
+        self._ping_period = ping_period
+        self._ping_timeout = ping_timeout
+        self._ping_id = 0
+        self._last_read = 0
+        self._connected = False
+        self._reader = None
+        self._writer = None
+        self._tasks = []
+        self._notifications = None
+
+    async def _write(self, msg):
+        LOGGER.debug('>>> %s' % msg)
+        self._writer.write(msg.encode('utf-8'))
+        await self._writer.drain()
+
+    async def _read(self):
+        data = await self._reader.read(xmpp.RECV_SIZE)
+        if not data:
+            raise Exception('xmpp socket closed')
+        LOGGER.debug('<<< %r' % data)
+        self._last_read = time.monotonic()
+        self._xmlparser.feed(data)
+
+    async def _msg(self, msg=None):
+        """send a message to the XMPP server, and wait for a response
+        returns the XML element tree of the response"""
+        if msg is not None:
+            await self._write(msg)
+
+        while True:
+            elem = self._handler.get_elem()
+            if elem is not None:
+                return elem
+            await self._read()
+
+    async def connect(self, host, port, auth):
+        """Establish a new connection to the XMPP server"""
+        await self.close()
+
+        LOGGER.info('Establishing connection to xmpp server %s:%i' %
+                    (host, port))
+        loop = asyncio.get_event_loop()
+        # Reading the access token may block on a refresh
+        auth_string = await loop.run_in_executor(
+            None,
+            xmpp.sasl_auth_string,
+            auth,
+        )
+
+        try:
+            await asyncio.wait_for(
+                self._login(host, port, auth_string),
+                xmpp.CONNECT_TIMEOUT,
+            )
+        except Exception:
+            await self.close()
+            raise
+
+        LOGGER.info('xmpp connection established')
+        self._connected = True
+        self._notifications = asyncio.Queue()
+        self._tasks = [
+            asyncio.ensure_future(self._read_loop()),
+            asyncio.ensure_future(self._keepalive_loop()),
+            asyncio.ensure_future(self._ping_loop()),
+        ]
+
+    async def _login(self, host, port, auth_string):
+        ssl_context = self._ssl_context
+        if ssl_context is None:
+            ssl_context = xmpp.ssl_context()
+        self._reader, self._writer = await asyncio.open_connection(
+            host,
+            port,
+            ssl=ssl_context,
+            server_hostname=host if ssl_context else None,
+        )
+        xmpp.set_tcp_keepalive(self._writer.get_extra_info('socket'))
+
+        self._handler = xmpp.XmppXmlHandler()
+        self._xmlparser = XMLParser(target=self._handler)
+
+        await self._msg(xmpp.STREAM_START)
+        await self._msg(xmpp.AUTH % auth_string)
+        await self._msg(xmpp.STREAM_START)
+        iq = await self._msg(xmpp.BIND)
+        await self._msg(xmpp.SESSION)
+        await self._msg(xmpp.SUBSCRIBE % xmpp.bound_jid(iq))
+
+    async def _read_loop(self):
+        try:
+            while True:
+                printer_ids = self._handler.get_notifications()
+                if printer_ids is not None:
+                    self._notifications.put_nowait(printer_ids)
+                await self._read()
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            LOGGER.warning('Error in xmpp connection: %s' % error)
+            self._lost(error)
+
+    async def _keepalive_loop(self):
+        while True:
+            await asyncio.sleep(self._keepalive_period)
+            LOGGER.info('Sending XMPP keepalive')
+            try:
+                await self._write(' ')
+            except Exception as error:
+                LOGGER.warning('Unable to send xmpp keepalive: %s' % error)
+                self._lost(error)
+                return
+
+    async def _ping_loop(self):
+        while True:
+            idle = time.monotonic() - self._last_read
+            if idle < self._ping_period:
+                await asyncio.sleep(self._ping_period - idle)
+                continue
+
+            LOGGER.debug('Sending XMPP ping')
+            self._ping_id += 1
+            sent = time.monotonic()
+            try:
+                await self._write(xmpp.PING % self._ping_id)
+            except Exception as error:
+                self._lost(error)
+                return
+            await asyncio.sleep(self._ping_timeout)
+            if self._last_read < sent:
+                LOGGER.warning('No answer to xmpp ping in %.0f seconds' %
+                               self._ping_timeout)
+                self._lost(Exception('xmpp connection is dead'))
+                return
+
+    def _lost(self, error):
+        self._connected = False
+        self._notifications.put_nowait(error)
+
+    async def close(self):
+        """Close the connection to the XMPP server"""
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self._connected = False
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except Exception:
+                # close() is best effort. Don't respond to failures
+                LOGGER.debug('Error encountered closing XMPP socket')
+            self._writer = None
+            self._reader = None
+
+    def is_connected(self):
+        return self._connected
+
+    def wake(self):
+        """Make the current or next call to await_notification return None
+        right away. Must be called on the event loop."""
+        if self._notifications is not None:
+            self._notifications.put_nowait(None)
+
+    async def await_notification(self, timeout):
+        """wait for a timeout or event notification
+        returns None on timeout or wake(), or else the set of printer ids
+        named by the notifications; the set is empty if no printer could be
+        identified"""
+        try:
+            item = await asyncio.wait_for(self._notifications.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if item is None:
+            return None
+
+        printer_ids = set()
+        every_printer = False
+        while True:
+            if isinstance(item, Exception):
+                await self.close()
+                raise item
+            if item is None:
+                # a wakeup, which returning now answers as well
+                pass
+            elif item:
+                printer_ids |= item
+            else:
+                # a notification for every printer
+                every_printer = True
+            try:
+                item = self._notifications.get_nowait()
+            except asyncio.QueueEmpty:
+                if every_printer:
+                    return set()
+                return printer_ids
+
+
+class XmppThread(object):
+    """Runs an AsyncXmppConnection on an event loop in a background thread.
+
+    It has the same blocking interface as XmppConnection, so the job loop
+    can use either one. Stanzas and keepalives are handled on the event
+    loop while the job loop is busy printing.
+    """
+
+    def __init__(self, keepalive_period=60.0, ssl_context=None,
+                 ping_period=xmpp.PING_PERIOD,
+                 ping_timeout=xmpp.PING_TIMEOUT):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever,
+            name='cloudprint-xmpp',
+        )
+        self._thread.daemon = True
+        self._thread.start()
+        self._conn = AsyncXmppConnection(
+            keepalive_period,
+            ssl_context,
+            ping_period,
+            ping_timeout,
+        )
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def connect(self, host, port, auth):
+        self._call(self._conn.connect(host, port, auth))
+
+    def close(self):
+        self._call(self._conn.close())
+
+    def is_connected(self):
+        return self._conn.is_connected()
+
+    def wake(self):
+        self._loop.call_soon_threadsafe(self._conn.wake)
+
+    def await_notification(self, timeout):
+        return self._call(self._conn.await_notification(timeout))
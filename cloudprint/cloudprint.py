@@ -19,24 +19,37 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import concurrent.futures
 import configargparse
+import contextlib
 import cups
 import datetime
-import hashlib
 import io
 import json
 import logging
 import logging.handlers
 import os
-import re
 import requests
-import shutil
+import socket
 import stat
 import sys
 import tempfile
+import threading
 import time
 import uuid
-
+import weakref
+
+from requests.packages.urllib3 import connectionpool
+
+from cloudprint import acks
+from cloudprint import asyncxmpp
+from cloudprint import jobs
+from cloudprint import poll
+from cloudprint import ppdcache
+from cloudprint import printerfilter
+from cloudprint import retry
+from cloudprint import scheduler
+from cloudprint import watchdog
 from cloudprint import xmpp
 
 
@@ -55,15 +68,90 @@ PRINT_CLOUD_URL = 'https://www.google.com/cloudprint/'
 POLL_PERIOD = 3600.0
 FAST_POLL_PERIOD = 30.0
 
-# wait period to retry when xmpp fails
-FAIL_RETRY = 60
+# bounds, in seconds, of the adaptive poll interval
+MIN_POLL_PERIOD = FAST_POLL_PERIOD
+MAX_POLL_PERIOD = POLL_PERIOD
+
+# the job loop waits FAIL_RETRY_MIN after the first failure and backs off up
+# to FAST_POLL_PERIOD; every retry also polls for jobs, which is how they are
+# found while xmpp is down
+FAIL_RETRY_MIN = 0.5
 
 # how often, in seconds, to send a keepalive character over xmpp
 KEEPALIVE = 600.0
 
-# failed job retries
-RETRIES = 1
-num_retries = 0
+# milliseconds to keep collecting notifications after the first one, so a
+# burst of them leads to a single sweep
+NOTIFY_DEBOUNCE = 500
+
+# number of keep-alive connections to keep per host in the shared HTTP pool
+HTTP_POOL_SIZE = 10
+
+# connect and read timeouts, in seconds, for every call to cloud print
+HTTP_CONNECT_TIMEOUT = 10.0
+HTTP_READ_TIMEOUT = 60.0
+
+# backoff bounds, in seconds, for retrying a failed background token refresh
+TOKEN_REFRESH_MIN_BACKOFF = 1.0
+TOKEN_REFRESH_MAX_BACKOFF = 300.0
+
+# number of concurrent /fetch requests when jobs have to be fetched per printer
+FETCH_WORKERS = 8
+
+# errorCode returned by /fetch when there are no jobs waiting
+FETCH_NO_JOBS = 413
+
+# errorCodes returned by /fetch when it will not fetch the jobs of every
+# printer of a proxy at once; any other error is taken to be temporary
+FETCH_BATCH_UNSUPPORTED = (7,)
+
+# how long, in seconds, the remote printer list is cached between job sweeps
+PRINTER_CACHE_TTL = 300.0
+
+# number of jobs printed at once, across all printers and on one printer
+JOB_WORKERS = 4
+PRINTER_JOB_WORKERS = 1
+
+# size, in bytes, of the chunks documents are streamed to CUPS in
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# prefix of the temporary files jobs are spooled to, how often, in seconds,
+# to look for ones left behind by a crash, and how old they must be to go
+SPOOL_PREFIX = 'cloudprint-'
+SPOOL_CLEANUP_PERIOD = 3600.0
+SPOOL_MAX_AGE = 24 * 3600.0
+
+# seconds a job may take, from fetching its document to handing it to CUPS,
+# before it is abandoned and retried
+JOB_DEADLINE = 600.0
+
+# seconds a task of the job loop may take before the watchdog considers it
+# stuck, logs where and closes the cloud print connections it is using
+TASK_DEADLINE = 300.0
+WATCHDOG = watchdog.Watchdog()
+
+# number of job statuses sent to cloud print at once
+ACK_WORKERS = 4
+
+# number of printers synchronized with cloud print at once
+SYNC_WORKERS = 4
+
+# number of characters of PPD text cached in memory
+PPD_CACHE_SIZE = 32 * 1024 * 1024
+PPD_CACHE = ppdcache.PPDCache(PPD_CACHE_SIZE)
+
+# how often, in seconds, to check for CUPS printers being added, removed or
+# changed, and how long our CUPS notification subscription lasts
+CUPS_WATCH_PERIOD = 30.0
+CUPS_SUBSCRIPTION_LEASE = 3600
+
+# failed job retries, and the bounds in seconds of the backoff between them
+RETRIES = 3
+RETRY_BACKOFF = 10.0
+RETRY_MAX_BACKOFF = 600.0
+
+# errors which retrying a job will not fix, such as CUPS rejecting a document
+PERMANENT_ERRORS = (cups.IPPError,)
 
 LOGGER = logging.getLogger('cloudprint')
 LOGGER.setLevel(logging.INFO)
@@ -77,31 +165,167 @@ def unicode_escape(string):
     return string.encode('unicode-escape').decode('ascii')
 
 
+def ppd_hash(ppd):
+    """The capsHash cloud print keeps for a printer with this PPD"""
+    return PPD_CACHE.digest(ppd)
+
+
+class JobTimeout(Exception):
+    """A job ran past its deadline"""
+
+
+class TimeoutSession(requests.Session):
+    """A requests session which applies a default timeout to every
+    request"""
+
+    def __init__(self, timeout):
+        super(TimeoutSession, self).__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super(TimeoutSession, self).request(method, url, **kwargs)
+
+
+# urllib3 connections checked out of a pool, and the ident of the thread
+# using each of them
+_in_flight = weakref.WeakKeyDictionary()
+_in_flight_lock = threading.Lock()
+
+
+class TrackedPool(object):
+    """Mixin for urllib3 connection pools which records the connections
+    in use, so close_connections can find them"""
+
+    def _get_conn(self, timeout=None):
+        conn = super(TrackedPool, self)._get_conn(timeout)
+        with _in_flight_lock:
+            _in_flight[conn] = threading.current_thread().ident
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            with _in_flight_lock:
+                _in_flight.pop(conn, None)
+        super(TrackedPool, self)._put_conn(conn)
+
+
+class TrackedHTTPConnectionPool(TrackedPool,
+                                connectionpool.HTTPConnectionPool):
+    pass
+
+
+class TrackedHTTPSConnectionPool(TrackedPool,
+                                 connectionpool.HTTPSConnectionPool):
+    pass
+
+
+class TrackedHTTPAdapter(requests.adapters.HTTPAdapter):
+    """An HTTPAdapter whose connections close_connections can close"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(TrackedHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TrackedHTTPConnectionPool,
+            'https': TrackedHTTPSConnectionPool,
+        }
+
+
+def close_connections(thread_id):
+    """Shut down the sockets of the cloud print connections the thread
+    thread_id is using, so a call blocked reading from one fails. Other
+    connections, and the pools, are left alone."""
+    with _in_flight_lock:
+        conns = [
+            conn for conn, ident in list(_in_flight.items())
+            if ident == thread_id
+        ]
+    for conn in conns:
+        sock = getattr(conn, 'sock', None)
+        if sock is None:
+            continue
+        LOGGER.warning('Closing connection to %s' % conn.host)
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except (IOError, OSError):
+            # closed already
+            pass
+
+
 class CloudPrintAuth(object):
     AUTH_POLL_PERIOD = 10.0
 
-    def __init__(self, auth_path):
+    # how long before the real expiry an access token is due for renewal
+    TOKEN_SLOP = datetime.timedelta(minutes=15)
+
+    def __init__(self, auth_path, pool_size=HTTP_POOL_SIZE,
+                 timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)):
         self.auth_path = auth_path
+        self.pool_size = pool_size
+        self.timeout = timeout
         self.guid = None
         self.email = None
         self.xmpp_jid = None
         self.exp_time = None
         self.refresh_token = None
         self._access_token = None
+        self._valid_until = None
+        self._refresh_lock = threading.Lock()
+        self.background_refresh = False
+        self._session = None
+        self._session_lock = threading.Lock()
 
     @property
     def session(self):
-        s = requests.session()
+        """A long-lived HTTP session shared by every cloud print call.
+
+        The session keeps a pool of keep-alive connections, so repeated
+        calls reuse the same TLS connection instead of paying a new
+        handshake each time. The Authorization header is kept in sync with
+        the current access token."""
+        token = self.access_token
+        with self._session_lock:
+            if self._session is None:
+                self._session = self._new_session()
+            self._session.headers['Authorization'] = 'Bearer {0}'.format(
+                token
+            )
+            return self._session
+
+    def _new_session(self):
+        s = TimeoutSession(self.timeout)
+        adapter = TrackedHTTPAdapter(
+            pool_connections=self.pool_size,
+            pool_maxsize=self.pool_size,
+        )
+        s.mount('https://', adapter)
+        s.mount('http://', adapter)
         s.headers['X-CloudPrint-Proxy'] = 'ArmoooIsAnOEM'
-        s.headers['Authorization'] = 'Bearer {0}'.format(self.access_token)
         return s
 
     @property
     def access_token(self):
-        if datetime.datetime.now() > self.exp_time:
-            self.refresh()
+        now = datetime.datetime.now()
+        if now > self.exp_time and not (
+            # With background_refresh, the job loop renews a token which is
+            # due but still usable, so we only block once it has expired
+            self.background_refresh and
+            self._valid_until is not None and
+            now < self._valid_until
+        ):
+            self.refresh_if_stale()
         return self._access_token
 
+    def refresh_if_stale(self):
+        """Refresh the access token if it is due for renewal.
+
+        Only one refresh is in flight at a time; concurrent callers wait for
+        it and then reuse its result."""
+        with self._refresh_lock:
+            now = datetime.datetime.now()
+            if self.exp_time is None or now > self.exp_time:
+                self.refresh()
+
     def no_auth(self):
         return not os.path.exists(self.auth_path)
 
@@ -117,9 +341,10 @@ class CloudPrintAuth(object):
                 'defaults': ppd.encode('utf-8'),
                 'status': 'OK',
                 'description': description,
-                'capsHash': hashlib.sha1(ppd.encode('utf-8')).hexdigest(),
+                'capsHash': ppd_hash(ppd),
             },
             headers={'X-CloudPrint-Proxy': 'ArmoooIsAnOEM'},
+            timeout=self.timeout,
         ).json()
         print('Go to {0} to claim this printer'.format(
             reg_data['complete_invite_url']
@@ -132,6 +357,7 @@ class CloudPrintAuth(object):
             poll = requests.get(
                 reg_data['polling_url'] + CLIENT_ID,
                 headers={'X-CloudPrint-Proxy': 'ArmoooIsAnOEM'},
+                timeout=self.timeout,
             ).json()
             if poll['success']:
                 break
@@ -150,7 +376,8 @@ class CloudPrintAuth(object):
                 'client_secret': CLIENT_KEY,
                 'grant_type': 'authorization_code',
                 'code': poll['authorization_code'],
-            }
+            },
+            timeout=self.timeout,
         ).json()
 
         self.refresh_token = token['refresh_token']
@@ -166,13 +393,29 @@ class CloudPrintAuth(object):
                 'client_secret': CLIENT_KEY,
                 'grant_type': 'refresh_token',
                 'refresh_token': self.refresh_token,
-            }
+            },
+            timeout=self.timeout,
         ).json()
-        self._access_token = token['access_token']
-
-        slop_time = datetime.timedelta(minutes=15)
         expires_in = datetime.timedelta(seconds=token['expires_in'])
-        self.exp_time = datetime.datetime.now() + (expires_in - slop_time)
+        self._set_access_token(
+            token['access_token'],
+            datetime.datetime.now() + expires_in,
+        )
+
+        # Keep the cached token on disk current for the next warm start.
+        if os.path.exists(self.auth_path):
+            self.save()
+
+    def _set_access_token(self, access_token, valid_until):
+        self._access_token = access_token
+        self._valid_until = valid_until
+        self.exp_time = valid_until - self.TOKEN_SLOP
+
+        with self._session_lock:
+            if self._session is not None:
+                self._session.headers['Authorization'] = 'Bearer {0}'.format(
+                    self._access_token
+                )
 
     def load(self):
         if os.path.exists(self.auth_path):
@@ -183,6 +426,20 @@ class CloudPrintAuth(object):
             self.email = auth_data['email']
             self.refresh_token = auth_data['refresh_token']
 
+            # Reuse the access token saved by the previous process if it is
+            # not yet due for renewal.
+            if auth_data.get('access_token') and auth_data.get('expires'):
+                valid_until = datetime.datetime.fromtimestamp(
+                    auth_data['expires']
+                )
+                if datetime.datetime.now() < valid_until - self.TOKEN_SLOP:
+                    self._set_access_token(
+                        auth_data['access_token'],
+                        valid_until,
+                    )
+                    LOGGER.debug('Reusing saved access token')
+                    return
+
         self.refresh()
 
     def delete(self):
@@ -190,18 +447,39 @@ class CloudPrintAuth(object):
             os.unlink(self.auth_path)
 
     def save(self):
-            if not os.path.exists(self.auth_path):
-                with open(self.auth_path, 'w') as auth_file:
-                    os.chmod(self.auth_path, stat.S_IRUSR | stat.S_IWUSR)
-            with open(self.auth_path, 'w') as auth_file:
-                json.dump({
-                    'guid':  self.guid,
-                    'email': self.email,
-                    'xmpp_jid': self.xmpp_jid,
-                    'refresh_token': self.refresh_token,
-                    },
-                    auth_file
-                )
+        auth_data = {
+            'guid':  self.guid,
+            'email': self.email,
+            'xmpp_jid': self.xmpp_jid,
+            'refresh_token': self.refresh_token,
+        }
+        if self._access_token is not None and self._valid_until is not None:
+            auth_data['access_token'] = self._access_token
+            auth_data['expires'] = time.mktime(
+                self._valid_until.timetuple()
+            )
+
+        # Write to a private temporary file next to the auth file and rename
+        # it into place, so a crash never leaves a truncated auth file.
+        auth_dir = os.path.dirname(os.path.abspath(self.auth_path))
+        fd, tmp_path = tempfile.mkstemp(dir=auth_dir, prefix='.cloudprint')
+        try:
+            auth_file = os.fdopen(fd, 'w')
+        except Exception:
+            # the file object never took over fd
+            os.close(fd)
+            os.unlink(tmp_path)
+            raise
+        try:
+            with auth_file:
+                os.chmod(tmp_path, stat.S_IRUSR | stat.S_IWUSR)
+                json.dump(auth_data, auth_file)
+                auth_file.flush()
+                os.fsync(auth_file.fileno())
+            os.rename(tmp_path, self.auth_path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
 
 
 class CloudPrintProxy(object):
@@ -209,11 +487,42 @@ class CloudPrintProxy(object):
     def __init__(self, auth):
         self.auth = auth
         self.sleeptime = 0
-        self.site = ''
-        self.include = []
-        self.exclude = []
+        self.printer_filter = printerfilter.PrinterFilter()
+        self.batch_fetch = True
+        self.spool_jobs = False
+        self.job_deadline = JOB_DEADLINE
+        self.acks = None
+        self.retries = retry.RetryQueue(
+            RETRIES,
+            retry.Backoff(RETRY_BACKOFF, RETRY_MAX_BACKOFF),
+            permanent=PERMANENT_ERRORS,
+        )
+        self.fetch_workers = FETCH_WORKERS
+        self._fetch_pool = None
+        self.printer_cache_ttl = PRINTER_CACHE_TTL
+        self._printers = None
+        self._printers_time = 0
+        self._printers_generation = 0
+        self._printers_refreshing = False
+        self._printers_lock = threading.Lock()
+
+    @property
+    def site(self):
+        return self.printer_filter.site
+
+    @site.setter
+    def site(self, site):
+        self.printer_filter = printerfilter.PrinterFilter(
+            self.printer_filter.include,
+            self.printer_filter.exclude,
+            site,
+        )
 
     def get_printers(self):
+        """List the remote printers, and refresh the printer registry."""
+        with self._printers_lock:
+            generation = self._printers_generation
+
         printers = self.auth.session.post(
             PRINT_CLOUD_URL + 'list',
             {
@@ -221,15 +530,63 @@ class CloudPrintProxy(object):
                 'proxy': self.auth.guid,
             },
         ).json()
-        return [
+        printers = [
             PrinterProxy(
                 self,
                 p['id'],
-                re.sub('^' + self.site + '-', '', p['name'])
+                self.printer_filter.local_name(p['name']),
+                caps_hash=p.get('capsHash'),
+                description=p.get('description'),
             )
             for p in printers['printers']
         ]
 
+        with self._printers_lock:
+            # Don't cache a list that was invalidated while we fetched it
+            if generation == self._printers_generation:
+                self._printers = printers
+                self._printers_time = time.time()
+        return printers
+
+    def cached_printers(self):
+        """List the remote printers from the printer registry.
+
+        The registry is filled on first use, and refreshed in the background
+        once it is older than printer_cache_ttl."""
+        with self._printers_lock:
+            printers = self._printers
+            stale = time.time() - self._printers_time > self.printer_cache_ttl
+            refresh = stale and not self._printers_refreshing
+            if printers is not None and refresh:
+                self._printers_refreshing = True
+
+        if printers is None:
+            return self.get_printers()
+
+        if refresh:
+            thread = threading.Thread(
+                target=self._refresh_printers,
+                name='cloudprint-printer-refresh',
+            )
+            thread.daemon = True
+            thread.start()
+        return printers
+
+    def _refresh_printers(self):
+        try:
+            self.get_printers()
+        except Exception:
+            LOGGER.exception('Unable to refresh the printer list')
+        finally:
+            with self._printers_lock:
+                self._printers_refreshing = False
+
+    def invalidate_printers(self):
+        """Drop the printer registry, so the next lookup lists again."""
+        with self._printers_lock:
+            self._printers = None
+            self._printers_generation += 1
+
     def delete_printer(self, printer_id):
         self.auth.session.post(
             PRINT_CLOUD_URL + 'delete',
@@ -238,11 +595,11 @@ class CloudPrintProxy(object):
                 'printerid': printer_id,
             },
         ).raise_for_status()
+        self.invalidate_printers()
         LOGGER.debug('Deleted printer ' + printer_id)
 
     def add_printer(self, name, description, ppd):
-        if self.site:
-            name = self.site + '-' + name
+        name = self.printer_filter.remote_name(name)
         self.auth.session.post(
             PRINT_CLOUD_URL + 'register',
             {
@@ -253,14 +610,14 @@ class CloudPrintProxy(object):
                 'defaults': ppd.encode('utf-8'),
                 'status': 'OK',
                 'description': description,
-                'capsHash': hashlib.sha1(ppd.encode('utf-8')).hexdigest(),
+                'capsHash': ppd_hash(ppd),
             },
         ).raise_for_status()
+        self.invalidate_printers()
         LOGGER.debug('Added Printer ' + name)
 
     def update_printer(self, printer_id, name, description, ppd):
-        if self.site:
-            name = self.site + '-' + name
+        name = self.printer_filter.remote_name(name)
         self.auth.session.post(
             PRINT_CLOUD_URL + 'update',
             {
@@ -272,9 +629,10 @@ class CloudPrintProxy(object):
                 'defaults': ppd.encode('utf-8'),
                 'status': 'OK',
                 'description': description,
-                'capsHash': hashlib.sha1(ppd.encode('utf-8')).hexdigest(),
+                'capsHash': ppd_hash(ppd),
             },
         ).raise_for_status()
+        self.invalidate_printers()
         LOGGER.debug('Updated Printer ' + name)
 
     def get_jobs(self, printer_id):
@@ -291,34 +649,116 @@ class CloudPrintProxy(object):
         else:
             return docs['jobs']
 
-    def finish_job(self, job_id):
-        self.auth.session.post(
-            PRINT_CLOUD_URL + 'control',
+    def fetch_jobs(self, printers):
+        """Fetch the pending jobs of several printers.
+
+        Tries a single /fetch for every printer owned by this proxy, and falls
+        back to concurrent per-printer fetches if the service will not batch.
+        Returns a list of (printer, jobs) pairs in the order of printers."""
+        printers = list(printers)
+
+        jobs = None
+        if self.batch_fetch and len(printers) > 1:
+            jobs = self._fetch_proxy_jobs()
+        if jobs is None:
+            jobs = self._fetch_printer_jobs(printers)
+
+        return [(printer, jobs.get(printer.id, [])) for printer in printers]
+
+    def _fetch_proxy_jobs(self):
+        """Fetch the jobs of all of our printers in one request.
+
+        Returns a dict of printer id to jobs, or None if the service does
+        not support a proxy-wide fetch. Raises on any other error, so one
+        failed fetch does not turn batching off for good."""
+        LOGGER.info('Polling for jobs on all printers')
+        response = self.auth.session.post(
+            PRINT_CLOUD_URL + 'fetch',
             {
                 'output': 'json',
-                'jobid': job_id,
-                'status': 'DONE',
+                'proxy': self.auth.guid,
             },
-        ).json()
+        )
+        response.raise_for_status()
+        docs = response.json()
+
+        if 'jobs' not in docs:
+            error_code = docs.get('errorCode')
+            if error_code == FETCH_NO_JOBS:
+                return {}
+            if error_code in FETCH_BATCH_UNSUPPORTED:
+                return self._disable_batch_fetch()
+            raise Exception('Unable to fetch jobs: %s (errorCode %s)' % (
+                docs.get('message'),
+                error_code,
+            ))
+
+        jobs = {}
+        for job in docs['jobs']:
+            if 'printerid' not in job:
+                return self._disable_batch_fetch()
+            jobs.setdefault(job['printerid'], []).append(job)
+        return jobs
+
+    def _disable_batch_fetch(self):
+        LOGGER.info('Batched job fetch not supported, using per printer')
+        self.batch_fetch = False
+        return None
+
+    def _fetch_printer_jobs(self, printers):
+        if len(printers) <= 1 or self.fetch_workers <= 1:
+            return dict((p.id, p.get_jobs()) for p in printers)
+
+        if self._fetch_pool is None:
+            self._fetch_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.fetch_workers,
+            )
+        results = self._fetch_pool.map(lambda p: p.get_jobs(), printers)
+        return dict((p.id, jobs) for p, jobs in zip(printers, results))
+
+    def finish_job(self, job_id):
+        self._job_status(job_id, 'DONE')
         LOGGER.debug('Finished Job' + job_id)
 
     def fail_job(self, job_id):
-        self.auth.session.post(
+        self._job_status(job_id, 'ERROR')
+        LOGGER.debug('Failed Job' + job_id)
+
+    def _job_status(self, job_id, status):
+        # With an ack queue, the status is sent in the background
+        if self.acks is not None:
+            self.acks.put(job_id, status)
+        else:
+            self.send_job_status(job_id, status)
+
+    def send_job_status(self, job_id, status):
+        response = self.auth.session.post(
             PRINT_CLOUD_URL + 'control',
             {
                 'output': 'json',
                 'jobid': job_id,
-                'status': 'ERROR',
+                'status': status,
             },
-        ).json()
-        LOGGER.debug('Failed Job' + job_id)
+        )
+        response.raise_for_status()
+        response.json()
 
 
 class PrinterProxy(object):
-    def __init__(self, cpp, printer_id, name):
+    def __init__(self, cpp, printer_id, name, caps_hash=None,
+                 description=None):
         self.cpp = cpp
         self.id = printer_id
         self.name = name
+        self.caps_hash = caps_hash
+        self.description = description
+
+    def is_current(self, description, ppd):
+        """True if cloud print already has this description and PPD"""
+        return (
+            self.caps_hash == ppd_hash(ppd) and
+            self.description == description
+        )
 
     def get_jobs(self):
         LOGGER.info('Polling for jobs on ' + self.name)
@@ -331,138 +771,793 @@ class PrinterProxy(object):
         return self.cpp.delete_printer(self.id)
 
 
-# True if printer name matches *any* of the regular expressions in regexps
-def match_re(prn, regexps, empty=False):
-    if len(regexps):
-        try:
-            return (
-                re.match(regexps[0], prn, re.UNICODE)
-                or match_re(prn, regexps[1:])
-            )
-        except Exception:
-            sys.stderr.write(
-                'cloudprint: invalid regular expression: ' +
-                regexps[0] +
-                '\n'
-            )
-            sys.exit(1)
-    else:
-        return empty
+def ppd_version(printer_attrs):
+    """Return a value which changes whenever the PPD of a printer might have
+    changed, or None if CUPS doesn't tell us"""
+    for attr in ('printer-config-change-time', 'printer-state-change-time'):
+        if attr in printer_attrs:
+            return printer_attrs[attr]
+    return None
 
 
 def get_printer_info(cups_connection, printer_name):
-        # This is bad it should use the LanguageEncoding in the PPD
-        # But a lot of utf-8 PPDs seem to say they are ISOLatin1
-        ppd_path = cups_connection.getPPD(printer_name)
+    printer_attrs = cups_connection.getPrinterAttributes(printer_name)
+    description = printer_attrs['printer-info']
+
+    version = ppd_version(printer_attrs)
+    if version is not None:
+        ppd = PPD_CACHE.get(printer_name, version)
+        if ppd is not None:
+            return ppd, description
+
+    # This is bad it should use the LanguageEncoding in the PPD
+    # But a lot of utf-8 PPDs seem to say they are ISOLatin1
+    ppd_path = cups_connection.getPPD(printer_name)
+    try:
         with io.open(ppd_path, encoding='utf-8') as ppd_file:
             ppd = ppd_file.read()
+    finally:
+        # getPPD hands us a temporary copy
+        os.unlink(ppd_path)
+
+    if version is not None:
+        PPD_CACHE.put(printer_name, version, ppd)
+    return ppd, description
 
-        printer_attrs = cups_connection.getPrinterAttributes(printer_name)
-        description = printer_attrs['printer-info']
-        return ppd, description
 
+def sync_printers(cups_connection, cpp, workers=1, printer_names=None):
+    """Make the cloud printers of this proxy match the local CUPS printers.
 
-def sync_printers(cups_connection, cpp):
+    Only the printers in printer_names are synced, if it is given. With more
+    than one worker, printers are synced in parallel. Calls to CUPS are
+    serialized, as a cups.Connection is not thread-safe, while the calls to
+    cloud print run concurrently.
+    returns a list of (printer name, exception) for the printers which
+    could not be synced"""
     local_printer_names = set(cups_connection.getPrinters().keys())
     remote_printers = dict([(p.name, p) for p in cpp.get_printers()])
     remote_printer_names = set(remote_printers)
 
+    if printer_names is not None:
+        local_printer_names &= set(printer_names)
+        remote_printer_names &= set(printer_names)
+
     # Include/exclude local printers
-    local_printer_names = set([
-        prn for prn in local_printer_names
-        if match_re(prn, cpp.include, True)
-    ])
-    local_printer_names = set([
-        prn for prn in local_printer_names
-        if not match_re(prn, cpp.exclude)
-    ])
-
-    # New printers
-    for printer_name in local_printer_names - remote_printer_names:
-        try:
-            ppd, description = get_printer_info(cups_connection, printer_name)
-            cpp.add_printer(printer_name, description, ppd)
-        except (cups.IPPError, UnicodeDecodeError):
-            LOGGER.exception('Skipping ' + printer_name)
-
-    # Existing printers
-    for printer_name in local_printer_names & remote_printer_names:
-        ppd, description = get_printer_info(cups_connection, printer_name)
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        for printer_name in sorted(local_printer_names):
+            shared, reason = cpp.printer_filter.explain(printer_name)
+            LOGGER.debug('Printer %s %s' % (printer_name, reason))
+    local_printer_names = cpp.printer_filter.filter(local_printer_names)
+
+    cups_lock = threading.Lock()
+
+    def printer_info(printer_name):
+        with cups_lock:
+            return get_printer_info(cups_connection, printer_name)
+
+    def add(printer_name):
+        ppd, description = printer_info(printer_name)
+        cpp.add_printer(printer_name, description, ppd)
+
+    def update(printer_name):
+        ppd, description = printer_info(printer_name)
+        if remote_printers[printer_name].is_current(description, ppd):
+            LOGGER.debug('Printer %s is up to date' % printer_name)
+            return
         remote_printers[printer_name].update(description, ppd)
 
-    # Printers that have left us
-    for printer_name in remote_printer_names - local_printer_names:
+    def delete(printer_name):
         remote_printers[printer_name].delete()
 
+    tasks = (
+        # New printers
+        [(add, name) for name in local_printer_names - remote_printer_names] +
+        # Existing printers
+        [(update, name)
+         for name in local_printer_names & remote_printer_names] +
+        # Printers that have left us
+        [(delete, name)
+         for name in remote_printer_names - local_printer_names]
+    )
 
-def process_job(cups_connection, cpp, printer, job):
-    global num_retries
+    failures = []
+    if workers > 1 and len(tasks) > 1:
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            futures = [
+                (pool.submit(task, name), name) for task, name in tasks
+            ]
+            for future, printer_name in futures:
+                try:
+                    future.result()
+                except Exception as error:
+                    LOGGER.exception('Skipping ' + printer_name)
+                    failures.append((printer_name, error))
+    else:
+        for task, printer_name in tasks:
+            try:
+                task(printer_name)
+            except Exception as error:
+                LOGGER.exception('Skipping ' + printer_name)
+                failures.append((printer_name, error))
+
+    if failures:
+        LOGGER.error('Unable to sync %d printers: %s' % (
+            len(failures),
+            ', '.join(sorted(name for name, _ in failures)),
+        ))
+    return failures
 
-    try:
-        pdf = cpp.auth.session.get(job['fileUrl'], stream=True)
-        tmp = tempfile.NamedTemporaryFile(delete=False)
-        shutil.copyfileobj(pdf.raw, tmp)
-        tmp.flush()
 
-        options = cpp.auth.session.get(job['ticketUrl']).json()
-        if 'request' in options:
-            del options['request']
+class PrinterWatcher(object):
+    """Applies CUPS printers being added, removed or changed to cloud print.
 
-        options = dict((str(k), str(v)) for k, v in list(options.items()))
-        options['job-originating-user-name'] = job['ownerId']
+    Uses a CUPS notification subscription where the server allows it, and
+    otherwise compares the list of printers with the one it saw last."""
 
-        # Cap the title length to 255, or cups will complain about invalid
-        # job-name
-        cups_connection.printFile(
-            printer.name,
+    EVENTS = ['printer-added', 'printer-deleted', 'printer-modified']
+
+    # printer attributes compared when there is no subscription
+    SNAPSHOT_ATTRS = (
+        'printer-info',
+        'printer-location',
+        'printer-make-and-model',
+        'device-uri',
+    )
+
+    def __init__(self, cups_connection, cpp):
+        self.cups_connection = cups_connection
+        self.cpp = cpp
+        self.subscription_id = None
+        self._sequence = 1
+        self._renew_time = 0
+        self._snapshot = {}
+
+    def start(self):
+        self._snapshot = self._take_snapshot()
+        self._subscribe()
+
+    def stop(self):
+        if self.subscription_id is not None:
+            try:
+                self.cups_connection.cancelSubscription(self.subscription_id)
+            except cups.IPPError:
+                LOGGER.debug('Unable to cancel CUPS subscription')
+            self.subscription_id = None
+
+    def poll(self):
+        """Sync the printers which changed since the last call.
+        returns the names of those printers"""
+        printer_names = self.changed_printers()
+        if printer_names:
+            LOGGER.info(
+                'CUPS printers changed: ' + ', '.join(sorted(printer_names))
+            )
+            sync_printers(
+                self.cups_connection,
+                self.cpp,
+                printer_names=printer_names,
+            )
+        return printer_names
+
+    def changed_printers(self):
+        if self.subscription_id is None:
+            return self._diff()
+
+        try:
+            self._renew()
+            return self._notified_printers()
+        except cups.IPPError:
+            LOGGER.exception('Lost the CUPS subscription')
+            self.subscription_id = None
+            # Catch up on whatever happened since the last snapshot
+            printer_names = self._diff()
+            self._subscribe()
+            return printer_names
+
+    def _subscribe(self):
+        try:
+            self.subscription_id = self.cups_connection.createSubscription(
+                '/',
+                events=self.EVENTS,
+                lease_duration=CUPS_SUBSCRIPTION_LEASE,
+            )
+            self._sequence = 1
+            self._renew_time = time.time() + CUPS_SUBSCRIPTION_LEASE / 2
+        except cups.IPPError:
+            LOGGER.info('CUPS notifications are not available, '
+                        'polling for printer changes')
+            self.subscription_id = None
+
+    def _renew(self):
+        if time.time() >= self._renew_time:
+            self.cups_connection.renewSubscription(
+                self.subscription_id,
+                lease_duration=CUPS_SUBSCRIPTION_LEASE,
+            )
+            self._renew_time = time.time() + CUPS_SUBSCRIPTION_LEASE / 2
+
+    def _notified_printers(self):
+        result = self.cups_connection.getNotifications(
+            [self.subscription_id],
+            [self._sequence],
+        )
+        printer_names = set()
+        for event in result.get('notifications', []):
+            sequence = event.get('notify-sequence-number', 0)
+            if sequence < self._sequence:
+                continue
+            self._sequence = sequence + 1
+            if (
+                event.get('notify-subscribed-event') in self.EVENTS and
+                'printer-name' in event
+            ):
+                printer_names.add(event['printer-name'])
+        return printer_names
+
+    def _take_snapshot(self):
+        return dict(
+            (name, tuple(attrs.get(attr) for attr in self.SNAPSHOT_ATTRS))
+            for name, attrs in self.cups_connection.getPrinters().items()
+        )
+
+    def _diff(self):
+        snapshot = self._take_snapshot()
+        printer_names = set(
+            name for name in set(snapshot) | set(self._snapshot)
+            if snapshot.get(name) != self._snapshot.get(name)
+        )
+        self._snapshot = snapshot
+        return printer_names
+
+
+def before_deadline(chunks, deadline):
+    """Yield the chunks, but raise JobTimeout once the time.time() deadline
+    has passed. There is no deadline if it is None."""
+    for chunk in chunks:
+        if deadline is not None and time.time() > deadline:
+            raise JobTimeout('Job deadline passed')
+        yield chunk
+
+
+def print_stream(cups_connection, printer_name, title, options, stream,
+                 deadline=None):
+    """Submit a document to CUPS chunk by chunk as it is downloaded, without
+    spooling it to disk first.
+    returns the CUPS job id"""
+    job_id = cups_connection.createJob(printer_name, title, options)
+    try:
+        status = cups_connection.startDocument(
+            printer_name,
+            job_id,
+            title,
+            cups.CUPS_FORMAT_AUTO,
+            1,
+        )
+        if status != cups.HTTP_CONTINUE:
+            raise Exception('Unable to start document: HTTP %s' % status)
+
+        chunks = stream.iter_content(STREAM_CHUNK_SIZE)
+        for chunk in before_deadline(chunks, deadline):
+            status = cups_connection.writeRequestData(chunk, len(chunk))
+            if status != cups.HTTP_CONTINUE:
+                raise Exception('Unable to send document: HTTP %s' % status)
+
+        cups_connection.finishDocument(printer_name)
+    except Exception:
+        try:
+            cups_connection.cancelJob(job_id)
+        except cups.IPPError:
+            LOGGER.debug('Unable to cancel CUPS job %s' % job_id)
+        raise
+    return job_id
+
+
+def print_spooled(cups_connection, printer_name, title, options, stream,
+                  deadline=None):
+    """Submit a document to CUPS through a temporary file, for backends
+    which need a seekable file.
+    returns the CUPS job id"""
+    tmp = tempfile.NamedTemporaryFile(prefix=SPOOL_PREFIX, delete=False)
+    try:
+        with tmp:
+            chunks = iter(lambda: stream.raw.read(STREAM_CHUNK_SIZE), b'')
+            for chunk in before_deadline(chunks, deadline):
+                tmp.write(chunk)
+        return cups_connection.printFile(
+            printer_name,
             tmp.name,
-            job['title'][:255],
+            title,
             options,
         )
+    finally:
         os.unlink(tmp.name)
-        LOGGER.info(unicode_escape('SUCCESS ' + job['title']))
 
-        cpp.finish_job(job['id'])
-        num_retries = 0
 
-    except Exception:
-        if num_retries >= RETRIES:
-            num_retries = 0
-            cpp.fail_job(job['id'])
-            LOGGER.error(unicode_escape('ERROR ' + job['title']))
-        else:
-            num_retries += 1
-            LOGGER.info(
-                unicode_escape('Job %s failed - Will retry' % job['title'])
+def remove_stale_spool_files(directory=None, max_age=SPOOL_MAX_AGE):
+    """Remove the spool files older than max_age seconds from directory, or
+    the temporary directory. They are left behind when we die mid-job."""
+    if directory is None:
+        directory = tempfile.gettempdir()
+    cutoff = time.time() - max_age
+    for name in os.listdir(directory):
+        if not name.startswith(SPOOL_PREFIX):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.unlink(path)
+                LOGGER.info('Removed stale spool file ' + path)
+        except OSError:
+            # gone already
+            pass
+
+
+class JobTimer(object):
+    """Records how long each phase of printing a job took"""
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases.append((name, time.time() - start))
+
+    def format(self):
+        with self._lock:
+            phases = list(self.phases)
+        phases.append(('total', time.time() - self.start))
+        return ' '.join('%s=%.3fs' % phase for phase in phases)
+
+
+# Every job being printed fetches one ticket, so the ticket pool is as large
+# as the number of jobs printed at once
+_ticket_pool = None
+_ticket_workers = JOB_WORKERS
+_ticket_pool_lock = threading.Lock()
+
+
+def ticket_pool():
+    """The shared thread pool that job tickets are fetched on"""
+    global _ticket_pool
+    with _ticket_pool_lock:
+        if _ticket_pool is None:
+            _ticket_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=_ticket_workers,
             )
+        return _ticket_pool
 
 
-def process_jobs(cups_connection, cpp):
-    xmpp_conn = xmpp.XmppConnection(keepalive_period=KEEPALIVE)
+def set_ticket_workers(workers):
+    """Fetch up to workers job tickets at once"""
+    global _ticket_pool, _ticket_workers
+    with _ticket_pool_lock:
+        if workers == _ticket_workers:
+            return
+        _ticket_workers = workers
+        pool, _ticket_pool = _ticket_pool, None
+    if pool is not None:
+        # tickets already being fetched finish on the old pool
+        pool.shutdown(wait=False)
 
-    while True:
-        process_jobs_once(cups_connection, cpp, xmpp_conn)
+
+def fetch_ticket(cpp, job, timer):
+    """Fetch the job ticket of job, and turn it into CUPS options"""
+    with timer.phase('ticket'):
+        options = cpp.auth.session.get(job['ticketUrl']).json()
+    if 'request' in options:
+        del options['request']
+
+    options = dict((str(k), str(v)) for k, v in list(options.items()))
+    options['job-originating-user-name'] = job['ownerId']
+    return options
+
+
+def watch(name, timeout):
+    """Watch the task name, run by the current thread, with WATCHDOG. If
+    it is still running after timeout seconds, the connections it is
+    blocked on are closed."""
+    thread_id = threading.current_thread().ident
+    return WATCHDOG.watch(
+        name,
+        timeout,
+        lambda: close_connections(thread_id),
+    )
 
 
-def process_jobs_once(cups_connection, cpp, xmpp_conn):
-    printers = cpp.get_printers()
+def process_job(cups_connection, cpp, printer, job):
+    with watch('job %s' % job['id'], cpp.job_deadline):
+        _process_job(cups_connection, cpp, printer, job)
+
+
+def _process_job(cups_connection, cpp, printer, job):
+    timer = JobTimer()
+    deadline = None
+    if cpp.job_deadline:
+        deadline = time.time() + cpp.job_deadline
     try:
-        for printer in printers:
-            for job in printer.get_jobs():
-                process_job(cups_connection, cpp, printer, job)
+        # The ticket and the document are independent, so fetch the ticket
+        # while the document request is in flight.
+        ticket = ticket_pool().submit(fetch_ticket, cpp, job, timer)
+
+        with timer.phase('document'):
+            pdf = cpp.auth.session.get(job['fileUrl'], stream=True)
+            pdf.raise_for_status()
+
+        with timer.phase('ticket-wait'):
+            if deadline is not None:
+                options = ticket.result(max(0, deadline - time.time()))
+            else:
+                options = ticket.result()
+
+        if cpp.spool_jobs or not hasattr(cups_connection, 'createJob'):
+            submit = print_spooled
+        else:
+            submit = print_stream
 
-        if not xmpp_conn.is_connected():
-            xmpp_conn.connect(XMPP_SERVER_HOST, XMPP_SERVER_PORT, cpp.auth)
+        # Cap the title length to 255, or cups will complain about invalid
+        # job-name
+        with contextlib.closing(pdf), timer.phase('print'):
+            submit(
+                cups_connection,
+                printer.name,
+                job['title'][:255],
+                options,
+                pdf,
+                deadline,
+            )
+        LOGGER.info(unicode_escape('SUCCESS ' + job['title']))
+        LOGGER.info('Job %s timings: %s' % (job['id'], timer.format()))
+
+        cpp.retries.succeeded(job['id'])
+
+    except Exception as error:
+        delay = cpp.retries.failed(printer, job, error)
+        if delay is None:
+            LOGGER.exception(unicode_escape('ERROR ' + job['title']))
+            report_status(cpp.fail_job, job)
+        else:
+            LOGGER.info(unicode_escape(
+                'Job %s failed - Will retry in %d Seconds' %
+                (job['title'], delay)
+            ))
+        return
 
-        xmpp_conn.await_notification(cpp.sleeptime)
+    # CUPS has the document now, so failing to say so must not print it
+    # again
+    report_status(cpp.finish_job, job)
 
+
+def report_status(report, job):
+    """Call report(job id), logging rather than raising any error"""
+    try:
+        report(job['id'])
     except Exception:
+        LOGGER.exception('Unable to report the status of job %s' % job['id'])
+
+
+def process_jobs(cups_connection, cpp, job_workers=JOB_WORKERS,
+                 printer_job_workers=PRINTER_JOB_WORKERS, async_xmpp=False,
+                 debounce=NOTIFY_DEBOUNCE, poller=None):
+    if async_xmpp:
+        xmpp_conn = asyncxmpp.XmppThread(keepalive_period=KEEPALIVE)
+    else:
+        xmpp_conn = xmpp.XmppConnection(keepalive_period=KEEPALIVE)
+    set_ticket_workers(job_workers)
+    dispatcher = jobs.JobDispatcher(
+        lambda connection, printer, job: process_job(
+            connection, cpp, printer, job
+        ),
+        cups.Connection,
+        max_workers=job_workers,
+        per_printer=printer_job_workers,
+    )
+
+    loop = JobLoop(
+        cups_connection,
+        cpp,
+        xmpp_conn,
+        dispatcher,
+        debounce,
+        poller,
+    )
+    WATCHDOG.start()
+    if cpp.acks is not None:
+        cpp.acks.start()
+    loop.start()
+    loop.timers.run()
+
+
+def select_printers(cpp, printer_ids):
+    """Pick the printers named by printer_ids from the printer registry.
+
+    An id we don't know about means the registry is out of date, so it is
+    listed again before selecting."""
+    printers = cpp.cached_printers()
+    if not printer_ids:
+        return printers
+
+    if not printer_ids.issubset(p.id for p in printers):
+        cpp.invalidate_printers()
+        printers = cpp.cached_printers()
+    return [p for p in printers if p.id in printer_ids]
+
+
+def submit_job(cups_connection, cpp, printer, job, dispatcher=None):
+    """Hand job to dispatcher if given, or else print it right away.
+    returns False if the dispatcher already has the job"""
+    if dispatcher is not None:
+        return dispatcher.submit(printer, job)
+    process_job(cups_connection, cpp, printer, job)
+    return True
+
+
+def submit_retries(cups_connection, cpp, dispatcher=None):
+    """Submit the failed jobs which are due to be retried.
+    returns their ids"""
+    submitted = set()
+    for printer, job in cpp.retries.pop_due():
+        submitted.add(job['id'])
+        if not submit_job(cups_connection, cpp, printer, job, dispatcher):
+            # The dispatcher still has the last attempt; try again later
+            cpp.retries.rearm(job['id'])
+    return submitted
+
+
+def sweep_jobs(cups_connection, cpp, printer_ids=None, dispatcher=None,
+               poller=None):
+    """Submit the due retries, then the new jobs of printer_ids, or of every
+    printer if it is empty. poller is told how many new jobs were found.
+    returns that number"""
+    printers = select_printers(cpp, printer_ids)
+    submitted = submit_retries(cups_connection, cpp, dispatcher)
+
+    found = 0
+    for printer, printer_jobs in cpp.fetch_jobs(printers):
+        for job in printer_jobs:
+            # Failed jobs are left alone until their retry is due, a retry
+            # that just ran is not picked up again, and nor is a job whose
+            # status has not reached cloud print yet
+            if (
+                job['id'] not in cpp.retries and
+                job['id'] not in submitted and
+                (cpp.acks is None or job['id'] not in cpp.acks) and
+                submit_job(cups_connection, cpp, printer, job, dispatcher)
+            ):
+                found += 1
+    if poller is not None:
+        poller.swept(found, announced=printer_ids is not None)
+    return found
+
+
+def await_notifications(xmpp_conn, timeout, debounce=0):
+    """Wait for a notification like xmpp_conn.await_notification, then keep
+    collecting more for debounce milliseconds.
+    returns None on timeout, or else the merged set of printer ids; the set
+    is empty if any notification could not be tied to a printer"""
+    printer_ids = xmpp_conn.await_notification(timeout)
+    if printer_ids is None or debounce <= 0:
+        return printer_ids
+
+    deadline = time.time() + debounce / 1000.0
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return printer_ids
+        more = xmpp_conn.await_notification(remaining)
+        if more is None:
+            return printer_ids
+        if printer_ids and more:
+            printer_ids |= more
+        else:
+            # one of them is for every printer
+            printer_ids = set()
+
+
+class JobLoop(object):
+    """The daemon's main loop.
+
+    Job sweeps and polls, retry wakeups, xmpp reconnects, access token
+    renewal, printer resyncs and spool cleanup all run as timers on a
+    Scheduler. Between deadlines it waits for xmpp notifications, which
+    schedule a sweep of the printers they name. Jobs failing on dispatcher
+    threads call wake(), which interrupts the wait so the retry timer is
+    moved up on the loop's own thread.
+    """
+
+    def __init__(self, cups_connection, cpp, xmpp_conn, dispatcher=None,
+                 debounce=0, poller=None, clock=scheduler.monotonic,
+                 sleep=None):
+        self.cups_connection = cups_connection
+        self.cpp = cpp
+        self.xmpp_conn = xmpp_conn
+        self.dispatcher = dispatcher
+        self.debounce = debounce
+        self.poller = poller
+        self.timers = scheduler.Scheduler(
+            self.wait,
+            clock,
+            lambda name: watch(name, TASK_DEADLINE),
+        )
+        self.watcher = PrinterWatcher(cups_connection, cpp)
+        self._woken = threading.Event()
+        if sleep is None:
+            sleep = self._woken.wait
+        self._sleep = sleep
+        self._connect_backoff = retry.Backoff(FAIL_RETRY_MIN, FAST_POLL_PERIOD)
+        self._sweep_backoff = retry.Backoff(FAIL_RETRY_MIN, FAST_POLL_PERIOD)
+        self._token_backoff = retry.Backoff(
+            TOKEN_REFRESH_MIN_BACKOFF,
+            TOKEN_REFRESH_MAX_BACKOFF,
+        )
+        self._poll_timer = None
+        self._retry_timer = None
+        self._connect_timer = None
+
+    def start(self):
+        self.cpp.auth.background_refresh = True
+        self.cpp.retries.on_failed = self.wake
+        self.watcher.start()
+        self.timers.call_later(0, self.refresh_token)
+        self.timers.call_later(0, self.sweep)
+        self._connect_timer = self.timers.call_later(0, self.connect)
+        self.timers.call_later(CUPS_WATCH_PERIOD, self.resync)
+        self.timers.call_later(0, self.clean_spool)
+
+    def poll_interval(self):
+        if self.poller is not None:
+            return self.poller.interval
+        return self.cpp.sleeptime
+
+    def wake(self):
+        """Have the loop look at the retry queue again. May be called from
+        any thread."""
+        self._woken.set()
+        self.xmpp_conn.wake()
+
+    def wait(self, timeout):
+        if not self._woken.is_set():
+            self._wait(timeout)
+        if self._woken.is_set():
+            # The Scheduler is not thread-safe, so a retry recorded by
+            # another thread is scheduled here
+            self._woken.clear()
+            self._schedule_retry()
+
+    def _wait(self, timeout):
+        if not self.xmpp_conn.is_connected():
+            if self._connect_timer is None:
+                # The connection dropped between waits, with nothing
+                # left to notice; the timeout may be too long to wait
+                LOGGER.warning('Lost the connection to the Cloud Service')
+                self._schedule_connect()
+                return
+            self._sleep(timeout)
+            return
+
+        try:
+            printer_ids = await_notifications(
+                self.xmpp_conn,
+                timeout,
+                self.debounce,
+            )
+        except Exception:
+            self._lost_connection()
+            return
+        if printer_ids is not None:
+            self.timers.call_later(0, lambda: self.sweep(printer_ids))
+
+    def sweep(self, printer_ids=None):
+        """Submit the jobs of printer_ids, or of every printer if it is
+        empty"""
+        try:
+            sweep_jobs(
+                self.cups_connection,
+                self.cpp,
+                printer_ids,
+                self.dispatcher,
+                self.poller,
+            )
+        except Exception:
+            delay = self._sweep_backoff.next()
+            LOGGER.exception(
+                'ERROR: Could not fetch jobs. '
+                'Will Try again in %.1f Seconds' % delay
+            )
+            self._schedule_poll(delay, self.sweep)
+        else:
+            self._sweep_backoff.reset()
+            if not printer_ids:
+                self._schedule_poll(self.poll_interval(), self.poll)
+        self._schedule_retry()
+
+    def poll(self):
+        if self.poller is not None:
+            self.poller.timed_out()
+        self.sweep()
+
+    def _schedule_poll(self, delay, callback):
+        if self._poll_timer is not None:
+            self._poll_timer.cancel()
+        self._poll_timer = self.timers.call_later(delay, callback)
+
+    def retry(self):
+        self._retry_timer = None
+        submit_retries(self.cups_connection, self.cpp, self.dispatcher)
+        self._schedule_retry()
+
+    def _schedule_retry(self):
+        if self._retry_timer is not None:
+            self._retry_timer.cancel()
+            self._retry_timer = None
+        delay = self.cpp.retries.next_delay()
+        if delay is not None:
+            self._retry_timer = self.timers.call_later(delay, self.retry)
+
+    def connect(self):
+        self._connect_timer = None
+        try:
+            self.xmpp_conn.connect(
+                XMPP_SERVER_HOST,
+                XMPP_SERVER_PORT,
+                self.cpp.auth,
+            )
+        except Exception:
+            self._lost_connection()
+        else:
+            self._connect_backoff.reset()
+
+    def reconnect(self):
+        # Notifications sent while we were away are lost; poll for them
+        self.sweep()
+        self.connect()
+
+    def _lost_connection(self):
+        delay = self._schedule_connect()
         LOGGER.exception(
             'ERROR: Could not Connect to Cloud Service. '
-            'Will Try again in %d Seconds' %
-            FAIL_RETRY
+            'Will Try again in %.1f Seconds' % delay
         )
-        time.sleep(FAIL_RETRY)
+
+    def _schedule_connect(self):
+        delay = self._connect_backoff.next()
+        self._connect_timer = self.timers.call_later(delay, self.reconnect)
+        return delay
+
+    def refresh_token(self):
+        auth = self.cpp.auth
+        try:
+            auth.refresh_if_stale()
+        except Exception:
+            delay = self._token_backoff.next()
+            LOGGER.exception(
+                'Unable to refresh access token. '
+                'Will try again in %d Seconds' % delay
+            )
+        else:
+            self._token_backoff.reset()
+            delay = (auth.exp_time - datetime.datetime.now()).total_seconds()
+        self.timers.call_later(delay, self.refresh_token)
+
+    def resync(self):
+        try:
+            self.watcher.poll()
+        except Exception:
+            LOGGER.exception('Unable to sync changed printers')
+        self.timers.call_later(CUPS_WATCH_PERIOD, self.resync)
+
+    def clean_spool(self):
+        try:
+            remove_stale_spool_files()
+        except OSError:
+            LOGGER.exception('Unable to clean up the spool directory')
+        self.timers.call_later(SPOOL_CLEANUP_PERIOD, self.clean_spool)
 
 
 def parse_args():
@@ -508,6 +1603,22 @@ def parse_args():
         action='store_true',
         help='use fast poll if notifications are not working',
     )
+    parser.add_argument(
+        '--min-poll-period',
+        metavar='seconds',
+        dest='min_poll_period',
+        type=float,
+        default=MIN_POLL_PERIOD,
+        help='shortest time between polls for jobs (default %(default)s)',
+    )
+    parser.add_argument(
+        '--max-poll-period',
+        metavar='seconds',
+        dest='max_poll_period',
+        type=float,
+        default=MAX_POLL_PERIOD,
+        help='longest time between polls for jobs (default %(default)s)',
+    )
     parser.add_argument(
         '-i', '--include',
         metavar='regexp',
@@ -541,6 +1652,105 @@ def parse_args():
         default='',
         help='one-word site-name that will prefix printers',
     )
+    parser.add_argument(
+        '--http-pool-size',
+        metavar='size',
+        dest='http_pool_size',
+        type=int,
+        default=HTTP_POOL_SIZE,
+        help='number of keep-alive HTTP connections to keep open '
+             '(default %(default)s)',
+    )
+    parser.add_argument(
+        '--connect-timeout',
+        metavar='seconds',
+        dest='connect_timeout',
+        type=float,
+        default=HTTP_CONNECT_TIMEOUT,
+        help='time allowed to connect to cloud print (default %(default)s)',
+    )
+    parser.add_argument(
+        '--read-timeout',
+        metavar='seconds',
+        dest='read_timeout',
+        type=float,
+        default=HTTP_READ_TIMEOUT,
+        help='time allowed for cloud print to send more data '
+             '(default %(default)s)',
+    )
+    parser.add_argument(
+        '--job-deadline',
+        metavar='seconds',
+        dest='job_deadline',
+        type=float,
+        default=JOB_DEADLINE,
+        help='time allowed to print a job before it is retried '
+             '(default %(default)s)',
+    )
+    parser.add_argument(
+        '--fetch-workers',
+        metavar='count',
+        dest='fetch_workers',
+        type=int,
+        default=FETCH_WORKERS,
+        help='number of printers to fetch jobs for at once when jobs '
+             'cannot be fetched in a single request (default %(default)s)',
+    )
+    parser.add_argument(
+        '--ppd-cache-dir',
+        metavar='directory',
+        dest='ppd_cache_dir',
+        help='directory to cache printer PPDs in between restarts',
+    )
+    parser.add_argument(
+        '--sync-workers',
+        metavar='count',
+        dest='sync_workers',
+        type=int,
+        default=SYNC_WORKERS,
+        help='number of printers to sync with cloud print at once '
+             '(default %(default)s)',
+    )
+    parser.add_argument(
+        '--spool',
+        dest='spool',
+        action='store_true',
+        help='spool documents to a temporary file instead of streaming '
+             'them to cups, for backends that need a seekable file',
+    )
+    parser.add_argument(
+        '--async-xmpp',
+        dest='async_xmpp',
+        action='store_true',
+        help='handle xmpp notifications on an asyncio event loop, '
+             'alongside the printing of jobs',
+    )
+    parser.add_argument(
+        '--job-workers',
+        metavar='count',
+        dest='job_workers',
+        type=int,
+        default=JOB_WORKERS,
+        help='number of jobs to print at once (default %(default)s)',
+    )
+    parser.add_argument(
+        '--printer-job-workers',
+        metavar='count',
+        dest='printer_job_workers',
+        type=int,
+        default=PRINTER_JOB_WORKERS,
+        help='number of jobs to print at once on a single printer '
+             '(default %(default)s)',
+    )
+    parser.add_argument(
+        '--notify-debounce',
+        metavar='ms',
+        dest='notify_debounce',
+        type=int,
+        default=NOTIFY_DEBOUNCE,
+        help='milliseconds to wait for more notifications after one arrives, '
+             'before fetching jobs (default %(default)s)',
+    )
 
     return parser.parse_args()
 
@@ -581,7 +1791,22 @@ def main():
         requests_log.setLevel(logging.DEBUG)
         requests_log.propagate = True
 
-    auth = CloudPrintAuth(args.authfile)
+    # Check the printer filters before doing any network work
+    try:
+        printer_filter = printerfilter.PrinterFilter(
+            args.include,
+            args.exclude,
+            args.site,
+        )
+    except ValueError as error:
+        sys.stderr.write('cloudprint: {0}\n'.format(error))
+        sys.exit(1)
+
+    auth = CloudPrintAuth(
+        args.authfile,
+        pool_size=args.http_pool_size,
+        timeout=(args.connect_timeout, args.read_timeout),
+    )
     if args.logout:
         auth.delete()
         LOGGER.info('logged out')
@@ -591,12 +1816,27 @@ def main():
     cpp = CloudPrintProxy(auth)
 
     cpp.sleeptime = POLL_PERIOD
+    max_poll_period = args.max_poll_period
     if args.fastpoll:
         cpp.sleeptime = FAST_POLL_PERIOD
+        max_poll_period = min(max_poll_period, FAST_POLL_PERIOD)
+    poller = poll.AdaptivePoller(
+        min(args.min_poll_period, max_poll_period),
+        max_poll_period,
+        initial=cpp.sleeptime,
+    )
 
-    cpp.include = args.include
-    cpp.exclude = args.exclude
-    cpp.site = args.site
+    PPD_CACHE.directory = args.ppd_cache_dir
+    cpp.fetch_workers = args.fetch_workers
+    cpp.spool_jobs = args.spool
+    cpp.job_deadline = args.job_deadline
+    # Job statuses queued but not yet sent are kept next to the auth file
+    cpp.acks = acks.AckQueue(
+        args.authfile + '.acks',
+        cpp.send_job_status,
+        ACK_WORKERS,
+    )
+    cpp.printer_filter = printer_filter
 
     printers = list(cups_connection.getPrinters().keys())
     if not printers:
@@ -619,7 +1859,7 @@ def main():
     else:
         auth.load()
 
-    sync_printers(cups_connection, cpp)
+    sync_printers(cups_connection, cpp, args.sync_workers)
 
     if args.authonly:
         sys.exit(0)
@@ -641,10 +1881,26 @@ def main():
             timeout=5,
         )
         with daemon.DaemonContext(pidfile=pidfile):
-            process_jobs(cups_connection, cpp)
+            process_jobs(
+                cups_connection,
+                cpp,
+                args.job_workers,
+                args.printer_job_workers,
+                args.async_xmpp,
+                args.notify_debounce,
+                poller,
+            )
 
     else:
-        process_jobs(cups_connection, cpp)
+        process_jobs(
+            cups_connection,
+            cpp,
+            args.job_workers,
+            args.printer_job_workers,
+            args.async_xmpp,
+            args.notify_debounce,
+            poller,
+        )
 
 
 if __name__ == '__main__':
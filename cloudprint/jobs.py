@@ -0,0 +1,119 @@
+# Copyright 2014 Jason Michalski <armooo@armooo.net>
+#
+# This file is part of cloudprint.
+#
+# cloudprint is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cloudprint is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cloudprint.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import concurrent.futures
+import logging
+import threading
+
+from collections import deque
+
+LOGGER = logging.getLogger('cloudprint.jobs')
+
+
+class JobDispatcher(object):
+    """Runs print jobs on a pool of worker threads.
+
+    Jobs for different printers run in parallel, up to max_workers at once.
+    At most per_printer jobs of one printer run at the same time, and they
+    are started in the order they were submitted.
+
+    handler is called as handler(connection, printer, job), where connection
+    comes from connection_factory. Each worker thread gets its own
+    connection, since a cups.Connection can't be shared between threads.
+    """
+
+    def __init__(self, handler, connection_factory, max_workers=4,
+                 per_printer=1):
+        self.max_workers = max_workers
+        self.per_printer = per_printer
+        self._handler = handler
+        self._connection_factory = connection_factory
+        self._local = threading.local()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers,
+        )
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._queues = {}
+        self._running = {}
+        self._job_ids = set()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._connection_factory()
+            self._local.connection = connection
+        return connection
+
+    def submit(self, printer, job):
+        """Queue job to be printed on printer.
+        returns False if the job is already queued or running"""
+        with self._lock:
+            if job['id'] in self._job_ids:
+                return False
+            self._job_ids.add(job['id'])
+            self._queues.setdefault(printer.name, deque()).append(
+                (printer, job)
+            )
+            self._start_ready(printer.name)
+        return True
+
+    def is_active(self, job_id):
+        """True if job_id is queued or running"""
+        with self._lock:
+            return job_id in self._job_ids
+
+    def pending(self):
+        """Return the number of jobs queued or running"""
+        with self._lock:
+            return len(self._job_ids)
+
+    def wait(self, timeout=None):
+        """Wait until every submitted job has finished.
+        returns False if the timeout expired first"""
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._job_ids, timeout)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def _start_ready(self, key):
+        # Must be called with self._lock held
+        queue = self._queues.get(key)
+        while queue and self._running.get(key, 0) < self.per_printer:
+            printer, job = queue.popleft()
+            self._running[key] = self._running.get(key, 0) + 1
+            self._executor.submit(self._run, printer, job)
+        if not queue:
+            self._queues.pop(key, None)
+
+    def _run(self, printer, job):
+        try:
+            self._handler(self._connection(), printer, job)
+        except Exception:
+            LOGGER.exception('Unhandled error printing job %s' % job['id'])
+        finally:
+            with self._lock:
+                self._job_ids.discard(job['id'])
+                self._running[printer.name] -= 1
+                if not self._running[printer.name]:
+                    del self._running[printer.name]
+                self._start_ready(printer.name)
+                if not self._job_ids:
+                    self._idle.notify_all()
@@ -0,0 +1,70 @@
+# Copyright 2014 Jason Michalski <armooo@armooo.net>
+#
+# This file is part of cloudprint.
+#
+# cloudprint is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cloudprint is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cloudprint.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import logging
+
+LOGGER = logging.getLogger('cloudprint.poll')
+
+
+class AdaptivePoller(object):
+    """Picks how long to wait for a notification before polling for jobs.
+
+    A poll which finds jobs no notification announced means notifications
+    are not to be trusted, so the interval is divided by factor. Quiet
+    polls, and notifications which announce jobs before any poll does,
+    multiply it by factor. The interval stays between minimum and maximum.
+    """
+
+    def __init__(self, minimum, maximum, initial=None, factor=2.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        if initial is None:
+            initial = maximum
+        self.interval = self._clamp(initial)
+        self._polling = False
+
+    def _clamp(self, interval):
+        return max(self.minimum, min(self.maximum, interval))
+
+    def _set(self, interval):
+        interval = self._clamp(interval)
+        if interval != self.interval:
+            LOGGER.info('Polling for jobs every %d seconds' % interval)
+        self.interval = interval
+
+    def timed_out(self):
+        """Record that the wait for a notification timed out, so the next
+        sweep is a poll"""
+        self._polling = True
+
+    def swept(self, found, announced):
+        """Record a sweep which found found new jobs. announced is True if
+        the sweep was prompted by a notification."""
+        polling = self._polling
+        self._polling = False
+        if announced:
+            if found:
+                self._set(self.interval * self.factor)
+        elif polling:
+            if found:
+                LOGGER.info('Found %d jobs without a notification' % found)
+                self._set(self.interval / self.factor)
+            else:
+                self._set(self.interval * self.factor)
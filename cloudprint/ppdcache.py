@@ -0,0 +1,150 @@
+# Copyright 2014 Jason Michalski <armooo@armooo.net>
+#
+# This file is part of cloudprint.
+#
+# cloudprint is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cloudprint is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cloudprint.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+LOGGER = logging.getLogger('cloudprint.ppdcache')
+
+
+def sha1(ppd):
+    return hashlib.sha1(ppd.encode('utf-8')).hexdigest()
+
+
+class PPDCache(object):
+    """Caches decoded PPDs and their SHA-1, keyed by printer name and a
+    version that changes whenever the printer's PPD may have changed.
+
+    The in-memory layer holds at most max_size characters of PPD text and
+    evicts the least recently used entries first. If directory is given,
+    the latest version of each printer's PPD is also kept there, so it
+    survives a restart.
+    """
+
+    def __init__(self, max_size, directory=None):
+        self.max_size = max_size
+        self.directory = directory
+        # printer name -> (version, PPD text, digest); only the latest
+        # version of a printer's PPD is of any use
+        self._entries = OrderedDict()
+        self._digests = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, name, version):
+        """Return the PPD text of printer name at version, or None"""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(name)
+                return entry[1]
+
+        ppd = self._load(name, version)
+        if ppd is not None:
+            self._store(name, version, ppd[0], ppd[1])
+            return ppd[0]
+        return None
+
+    def put(self, name, version, ppd):
+        """Cache the PPD text of printer name at version, replacing any
+        other version cached for it"""
+        digest = sha1(ppd)
+        self._store(name, version, ppd, digest)
+        self._save(name, version, ppd, digest)
+
+    def digest(self, ppd):
+        """Return the SHA-1 of ppd, reusing the one computed when it was
+        cached"""
+        with self._lock:
+            digest = self._digests.get(ppd)
+        if digest is None:
+            return sha1(ppd)
+        return digest[0]
+
+    def _store(self, name, version, ppd, digest):
+        with self._lock:
+            old = self._entries.pop(name, None)
+            if old is not None:
+                self._forget(old)
+            if len(ppd) > self.max_size:
+                return
+
+            self._entries[name] = (version, ppd, digest)
+            # Printers may share a PPD, so its digest is counted per entry
+            self._digests.setdefault(ppd, [digest, 0])[1] += 1
+            self._size += len(ppd)
+            while self._size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self._forget(evicted)
+
+    def _forget(self, entry):
+        # Must be called with self._lock held
+        ppd = entry[1]
+        self._size -= len(ppd)
+        digest = self._digests[ppd]
+        digest[1] -= 1
+        if digest[1] == 0:
+            del self._digests[ppd]
+
+    def _path(self, name):
+        key = json.dumps(name).encode('utf-8')
+        return os.path.join(
+            self.directory,
+            hashlib.sha1(key).hexdigest() + '.json',
+        )
+
+    def _load(self, name, version):
+        if self.directory is None:
+            return None
+        try:
+            with io.open(self._path(name), encoding='utf-8') as f:
+                data = json.load(f)
+            if data['version'] != version:
+                return None
+            return data['ppd'], data['sha1']
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def _save(self, name, version, ppd, digest):
+        # There is one file per printer, which each new version replaces
+        if self.directory is None:
+            return
+        tmp_path = None
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+            with io.open(fd, 'w', encoding='utf-8') as f:
+                f.write(json.dumps({
+                    'version': version,
+                    'ppd': ppd,
+                    'sha1': digest,
+                }))
+            os.rename(tmp_path, self._path(name))
+        except (IOError, OSError):
+            LOGGER.exception('Unable to save the PPD of %s' % name)
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
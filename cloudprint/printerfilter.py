@@ -0,0 +1,129 @@
+# Copyright 2014 Jason Michalski <armooo@armooo.net>
+#
+# This file is part of cloudprint.
+#
+# cloudprint is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cloudprint is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cloudprint.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import re
+
+# a reference to a group by number, \1 or (?(1)...), which means nothing
+# once patterns are joined; escaped backslashes are removed before searching
+_NUMBERED_REFERENCE = re.compile(r'\\[1-9]|\(\?\(\d')
+
+
+class PrinterFilter(object):
+    """Decides which local printers are shared with cloud print.
+
+    include and exclude are lists of regular expressions matched against
+    the start of the printer name. A printer is shared if it matches any
+    include pattern (or there are none) and no exclude pattern. site is
+    prefixed to the name of every printer we register.
+
+    All patterns are compiled up front; a ValueError is raised for the
+    first one that is not a valid regular expression.
+    """
+
+    def __init__(self, include=(), exclude=(), site=''):
+        self.include = list(include)
+        self.exclude = list(exclude)
+        self.site = site
+
+        self._include = [self._compile(p) for p in self.include]
+        self._exclude = [self._compile(p) for p in self.exclude]
+        self._include_any = self._combine(self.include, self._include)
+        self._exclude_any = self._combine(self.exclude, self._exclude)
+        if site:
+            self._site = re.compile('^' + re.escape(site) + '-')
+        else:
+            self._site = None
+
+    @staticmethod
+    def _compile(pattern):
+        try:
+            return re.compile(pattern, re.UNICODE)
+        except re.error as error:
+            raise ValueError(
+                'invalid regular expression: %s (%s)' % (pattern, error)
+            )
+
+    @staticmethod
+    def _combine(patterns, compiled):
+        """Join patterns into a single regular expression, so a name is
+        checked against all of them in one match"""
+        if not patterns:
+            return None
+        # Joining renumbers the groups of every pattern after the first
+        if any(_NUMBERED_REFERENCE.search(p.replace('\\\\', ''))
+               for p in patterns):
+            return _AnyOf(compiled)
+        try:
+            return re.compile(
+                '|'.join('(?:%s)' % p for p in patterns),
+                re.UNICODE,
+            )
+        except re.error:
+            # e.g. the same group name used in two patterns
+            return _AnyOf(compiled)
+
+    def matches(self, name):
+        """True if the local printer name should be shared"""
+        if self._include_any is not None and not self._include_any.match(name):
+            return False
+        if self._exclude_any is not None and self._exclude_any.match(name):
+            return False
+        return True
+
+    def filter(self, names):
+        return set(name for name in names if self.matches(name))
+
+    def explain(self, name):
+        """Return (shared, reason) for the local printer name"""
+        if self._include:
+            for pattern in self._include:
+                if pattern.match(name):
+                    break
+            else:
+                return False, 'matches no include pattern'
+        for pattern in self._exclude:
+            if pattern.match(name):
+                return False, 'excluded by %s' % pattern.pattern
+        if self._include:
+            return True, 'included by %s' % pattern.pattern
+        return True, 'included by default'
+
+    def remote_name(self, name):
+        """The cloud print name of the local printer name"""
+        if self.site:
+            return self.site + '-' + name
+        return name
+
+    def local_name(self, name):
+        """The local name of the cloud print printer name"""
+        if self._site is None:
+            return name
+        return self._site.sub('', name, count=1)
+
+
+class _AnyOf(object):
+    def __init__(self, compiled):
+        self._compiled = compiled
+
+    def match(self, name):
+        for pattern in self._compiled:
+            match = pattern.match(name)
+            if match:
+                return match
+        return None
@@ -0,0 +1,169 @@
+# Copyright 2014 Jason Michalski <armooo@armooo.net>
+#
+# This file is part of cloudprint.
+#
+# cloudprint is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cloudprint is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cloudprint.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import random
+import threading
+import time
+
+import requests
+
+
+class Backoff(object):
+    """Exponential backoff with jitter.
+
+    The n-th delay (counting from 0) is initial * factor ** n, capped at
+    maximum, and then reduced by a random fraction of up to jitter so that
+    many clients failing together don't retry in lock step.
+    """
+
+    def __init__(self, initial, maximum, factor=2.0, jitter=0.5,
+                 random=random.random):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self._random = random
+        self._attempt = 0
+
+    def delay(self, attempt):
+        """Return the delay before retry number attempt"""
+        delay = min(self.maximum, self.initial * self.factor ** attempt)
+        return delay * (1 - self.jitter * self._random())
+
+    def next(self):
+        """Return the delay before the next retry, and count the attempt"""
+        delay = self.delay(self._attempt)
+        self._attempt += 1
+        return delay
+
+    def reset(self):
+        """Start again from the initial delay"""
+        self._attempt = 0
+
+
+def is_transient(error, permanent=()):
+    """True if the operation that raised error is worth retrying.
+
+    Network failures, timeouts and HTTP 5xx answers are transient, as well as
+    any other error we know nothing about. HTTP 4xx answers and errors of
+    the permanent types are not."""
+    if isinstance(error, permanent):
+        return False
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status >= 500 or status in (408, 429)
+    return True
+
+
+class RetryEntry(object):
+    def __init__(self, printer, job):
+        self.printer = printer
+        self.job = job
+        self.attempts = 0
+        self.due = None
+
+
+class RetryQueue(object):
+    """Tracks failed jobs until they are retried, keyed by job id.
+
+    Every job has its own attempt count and backoff, so one job failing does
+    not change how often another one is retried. If on_failed is set, it is
+    called whenever a retry is scheduled, from the thread calling failed().
+    """
+
+    def __init__(self, retries, backoff, permanent=(), clock=time.time,
+                 on_failed=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.permanent = permanent
+        self.on_failed = on_failed
+        self._clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, job_id):
+        with self._lock:
+            return job_id in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def failed(self, printer, job, error):
+        """Record that job failed with error.
+        returns the delay in seconds before it will be retried, or None if it
+        should not be retried"""
+        with self._lock:
+            entry = self._entries.pop(job['id'], None)
+            if entry is None:
+                entry = RetryEntry(printer, job)
+
+            if (
+                not is_transient(error, self.permanent) or
+                entry.attempts >= self.retries
+            ):
+                return None
+
+            delay = self.backoff.delay(entry.attempts)
+            entry.printer = printer
+            entry.job = job
+            entry.attempts += 1
+            entry.due = self._clock() + delay
+            self._entries[job['id']] = entry
+
+        if self.on_failed is not None:
+            self.on_failed()
+        return delay
+
+    def succeeded(self, job_id):
+        """Forget about job_id once it has been printed"""
+        with self._lock:
+            self._entries.pop(job_id, None)
+
+    def pop_due(self):
+        """Return the (printer, job) pairs which are due to be retried.
+
+        They stay in the queue, keeping their attempt count, until they
+        succeed or fail again."""
+        now = self._clock()
+        due = []
+        with self._lock:
+            for entry in self._entries.values():
+                if entry.due is not None and entry.due <= now:
+                    entry.due = None
+                    due.append((entry.printer, entry.job))
+        return due
+
+    def rearm(self, job_id):
+        """Make job_id due again, after the same backoff as its last
+        attempt, when it was popped but could not be retried"""
+        with self._lock:
+            entry = self._entries.get(job_id)
+            if entry is not None and entry.due is None:
+                delay = self.backoff.delay(max(0, entry.attempts - 1))
+                entry.due = self._clock() + delay
+
+    def next_delay(self):
+        """Return the seconds until the next retry is due, or None if no
+        retry is waiting"""
+        with self._lock:
+            dues = [e.due for e in self._entries.values() if e.due is not None]
+        if not dues:
+            return None
+        return max(0, min(dues) - self._clock())
@@ -0,0 +1,121 @@
+# Copyright 2014 Jason Michalski <armooo@armooo.net>
+#
+# This file is part of cloudprint.
+#
+# cloudprint is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cloudprint is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cloudprint.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import heapq
+import itertools
+import logging
+import time
+
+LOGGER = logging.getLogger('cloudprint.scheduler')
+
+# time.monotonic is not available before python 3.3
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+class Timer(object):
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler(object):
+    """Runs callbacks at their deadlines, from a single thread.
+
+    Timers are kept in a heap ordered by deadline on a monotonic clock.
+    Between deadlines the scheduler calls wait(timeout), which must return
+    after at most timeout seconds; it defaults to time.sleep. A wait
+    function which can be interrupted early, such as waiting for an xmpp
+    notification, may schedule new work before it returns.
+
+    If watch is given, each callback runs in the context manager returned
+    by watch(name), e.g. Watchdog.watch.
+    """
+
+    def __init__(self, wait=time.sleep, clock=monotonic, watch=None):
+        self._wait = wait
+        self._clock = clock
+        self._watch = watch
+        self._heap = []
+        self._counter = itertools.count()
+
+    def now(self):
+        return self._clock()
+
+    def call_at(self, when, callback):
+        """Run callback() once the clock reaches when.
+        returns a Timer, which can be cancelled"""
+        timer = Timer(when, callback)
+        # The counter keeps timers with the same deadline in FIFO order
+        heapq.heappush(self._heap, (when, next(self._counter), timer))
+        return timer
+
+    def call_later(self, delay, callback):
+        """Run callback() in delay seconds"""
+        return self.call_at(self._clock() + max(0, delay), callback)
+
+    def next_deadline(self):
+        """Return the deadline of the next timer, or None if there are
+        none"""
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return self._heap[0][0]
+
+    def run_pending(self):
+        """Run the callbacks of every timer which is due"""
+        now = self._clock()
+        while True:
+            deadline = self.next_deadline()
+            if deadline is None or deadline > now:
+                return
+            _, _, timer = heapq.heappop(self._heap)
+            try:
+                if self._watch is not None:
+                    with self._watch('task %r' % timer.callback):
+                        timer.callback()
+                else:
+                    timer.callback()
+            except Exception:
+                LOGGER.exception('Error in scheduled task %r' %
+                                 timer.callback)
+
+    def run_once(self):
+        """Run whatever is due, then wait until the next deadline, or for as
+        long as wait likes if there is none"""
+        self.run_pending()
+        self._wait(self._timeout())
+
+    def run(self):
+        """Run timers until there are none left"""
+        while True:
+            self.run_pending()
+            if self.next_deadline() is None:
+                return
+            self._wait(self._timeout())
+
+    def _timeout(self):
+        deadline = self.next_deadline()
+        if deadline is None:
+            return None
+        return max(0, deadline - self._clock())
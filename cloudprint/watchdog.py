@@ -0,0 +1,132 @@
+# Copyright 2014 Jason Michalski <armooo@armooo.net>
+#
+# This file is part of cloudprint.
+#
+# cloudprint is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cloudprint is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cloudprint.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import contextlib
+import itertools
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from cloudprint import scheduler
+
+LOGGER = logging.getLogger('cloudprint.watchdog')
+
+
+class Task(object):
+    def __init__(self, name, thread_id, deadline, recover):
+        self.name = name
+        self.thread_id = thread_id
+        self.deadline = deadline
+        self.recover = recover
+        self.fired = False
+
+
+class Watchdog(object):
+    """Notices tasks which run past their deadline.
+
+    Code runs a task inside watch(). Once the task is overdue, check() logs
+    the stack of the thread running it and calls its recover function, if
+    it has one, which should unblock the thread, e.g. by closing the socket
+    it is stuck on. start() runs check() every period seconds in a daemon
+    thread.
+    """
+
+    def __init__(self, timeout=None, recover=None, period=10.0,
+                 clock=scheduler.monotonic):
+        self.timeout = timeout
+        self.recover = recover
+        self.period = period
+        self._clock = clock
+        self._tasks = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @contextlib.contextmanager
+    def watch(self, name, timeout=None, recover=None):
+        """Watch the code run in the with block as the task name. timeout
+        and recover default to those of the watchdog; with no timeout the
+        task is never overdue."""
+        if timeout is None:
+            timeout = self.timeout
+        if recover is None:
+            recover = self.recover
+        if timeout is None:
+            yield
+            return
+
+        key = next(self._counter)
+        task = Task(
+            name,
+            threading.current_thread().ident,
+            self._clock() + timeout,
+            recover,
+        )
+        with self._lock:
+            self._tasks[key] = task
+        try:
+            yield
+        finally:
+            with self._lock:
+                del self._tasks[key]
+
+    def check(self):
+        """Deal with the tasks which are overdue.
+        returns their names"""
+        now = self._clock()
+        with self._lock:
+            overdue = [
+                task for task in self._tasks.values()
+                if not task.fired and task.deadline <= now
+            ]
+            for task in overdue:
+                task.fired = True
+
+        frames = sys._current_frames()
+        for task in overdue:
+            frame = frames.get(task.thread_id)
+            if frame is not None:
+                stack = ''.join(traceback.format_stack(frame))
+            else:
+                stack = '  (thread has exited)\n'
+            LOGGER.error('%s is stuck, at:\n%s' % (task.name, stack))
+            if task.recover is not None:
+                try:
+                    task.recover()
+                except Exception:
+                    LOGGER.exception('Unable to recover from stuck %s' %
+                                     task.name)
+        return [task.name for task in overdue]
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run,
+            name='cloudprint-watchdog',
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.period)
+            self.check()
@@ -29,31 +29,154 @@ from xml.etree.ElementTree import XMLParser, TreeBuilder
 LOGGER = logging.getLogger('cloudprint.xmpp')
 
 
+# bytes to ask for in each read from the xmpp socket
+RECV_SIZE = 16384
+
+# seconds allowed to connect and log in to the xmpp server
+CONNECT_TIMEOUT = 30.0
+
+# seconds without hearing from the server before we ping it, and how long
+# it has to answer before the connection is considered dead
+PING_PERIOD = 120.0
+PING_TIMEOUT = 30.0
+
+# TCP keepalive: idle seconds before the first probe, seconds between
+# probes, and unanswered probes before the kernel drops the connection
+TCP_KEEPALIVE_IDLE = 60
+TCP_KEEPALIVE_INTERVAL = 10
+TCP_KEEPALIVE_COUNT = 6
+
+PUSH_TAG = '{google:push}push'
+PUSH_DATA_TAG = '{google:push}data'
+
+# https://developers.google.com/cloud-print/docs/rawxmpp
+STREAM_START = (
+    '<stream:stream to="gmail.com" xml:lang="en" version="1.0" '
+    'xmlns:stream="http://etherx.jabber.org/streams" '
+    'xmlns="jabber:client">'
+)
+AUTH = (
+    '<auth xmlns="urn:ietf:params:xml:ns:xmpp-sasl" '
+    'mechanism="X-OAUTH2">%s</auth>'
+)
+BIND = (
+    '<iq type="set" id="0">'
+    '<bind xmlns="urn:ietf:params:xml:ns:xmpp-bind">'
+    '<resource>cloud_print</resource>'
+    '</bind>'
+    '</iq>'
+)
+SESSION = (
+    '<iq type="set" id="2">'
+    '<session xmlns="urn:ietf:params:xml:ns:xmpp-session"/>'
+    '</iq>'
+)
+SUBSCRIBE = (
+    '<iq type="set" id="3" to="%s">'
+    '<subscribe xmlns="google:push">'
+    '<item channel="cloudprint.google.com" '
+    'from="cloudprint.google.com"/>'
+    '</subscribe>'
+    '</iq>'
+)
+# XEP-0199
+PING = (
+    '<iq type="get" id="ping-%d">'
+    '<ping xmlns="urn:xmpp:ping"/>'
+    '</iq>'
+)
+
+
+_ssl_context = None
+
+
+def ssl_context():
+    """The SSL context shared by every xmpp connection, so TLS sessions can
+    be resumed when we reconnect"""
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
+
+def set_tcp_keepalive(sock):
+    """Have the kernel probe an idle connection, so a peer which silently
+    went away is noticed"""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # The tuning options are not available on every platform
+    for option, value in (
+        ('TCP_KEEPIDLE', TCP_KEEPALIVE_IDLE),
+        ('TCP_KEEPINTVL', TCP_KEEPALIVE_INTERVAL),
+        ('TCP_KEEPCNT', TCP_KEEPALIVE_COUNT),
+    ):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+def sasl_auth_string(auth):
+    """The X-OAUTH2 SASL credentials of auth"""
+    raw_auth_string = '\0{0}\0{1}'.format(
+        auth.xmpp_jid,
+        auth.access_token
+    ).encode('utf-8')
+    return base64.b64encode(raw_auth_string).decode('utf-8')
+
+
+def bound_jid(iq):
+    """The bare jid from the response to a BIND request"""
+    return iq[0][0].text.split('/')[0]
+
+
+def push_printer_id(elem):
+    """Return the printer id named by a google:push message, or None."""
+    data = elem.find('%s/%s' % (PUSH_TAG, PUSH_DATA_TAG))
+    if data is None or not data.text:
+        return None
+    try:
+        return base64.b64decode(data.text).decode('utf-8')
+    except (TypeError, ValueError):
+        LOGGER.warning('Unable to decode push data %r' % data.text)
+        return None
+
+
 class XmppXmlHandler(object):
+    """Builds each top-level stanza of an XMPP stream into an element tree.
+
+    Every stanza gets its own TreeBuilder, which is dropped once the stanza
+    is complete, so nothing from earlier stanzas is kept around for the
+    life of the stream."""
     STREAM_TAG = '{http://etherx.jabber.org/streams}stream'
 
     def __init__(self):
         self._stack = 0
-        self._builder = TreeBuilder()
-        self._builder.start('root', {})
+        self._builder = None
         self._results = deque()
 
     def data(self, data):
-        self._builder.data(data)
+        # Whitespace between stanzas has nowhere to go
+        if self._builder is not None:
+            self._builder.data(data)
 
     def start(self, tag, attrib):
         if tag == self.STREAM_TAG:
             return
 
+        if self._stack == 0:
+            self._builder = TreeBuilder()
         self._builder.start(tag, attrib)
         self._stack += 1
 
     def end(self, tag):
+        if self._stack == 0:
+            # the end of the stream itself
+            return
+
         self._stack -= 1
-        elem = self._builder.end(tag)
+        self._builder.end(tag)
 
         if self._stack == 0:
-            self._results.append(elem)
+            self._results.append(self._builder.close())
+            self._builder = None
 
     def get_elem(self):
         """If a top-level XML element has been completed since the last call to
@@ -69,29 +192,90 @@ class XmppXmlHandler(object):
         except IndexError:
             return None
 
+    def get_notifications(self):
+        """Consume the top-level elements received so far.
+        returns the set of printer ids named by the push notifications among
+        them, or None if there were no notifications; the set is empty if
+        any notification could not be tied to a printer"""
+        printer_ids = None
+        every_printer = False
+        while True:
+            elem = self.get_elem()
+            if elem is None:
+                if every_printer:
+                    return set()
+                return printer_ids
+
+            if elem.find(PUSH_TAG) is None:
+                LOGGER.debug('Ignoring xmpp stanza %s' % elem.tag)
+                continue
+
+            if printer_ids is None:
+                printer_ids = set()
+            printer_id = push_printer_id(elem)
+            if printer_id is None:
+                every_printer = True
+            else:
+                printer_ids.add(printer_id)
+
 
 class XmppConnection(object):
-    def __init__(self, keepalive_period=60.0):
+    def __init__(self, keepalive_period=60.0, recv_size=RECV_SIZE,
+                 ping_period=PING_PERIOD, ping_timeout=PING_TIMEOUT):
         self._connected = False
         self._wrappedsock = None
         self._keepalive_period = keepalive_period
+        self._recv_size = recv_size
+        self._ping_period = ping_period
+        self._ping_timeout = ping_timeout
+        self._tls_session = None
         self._nextkeepalive = time.time() + self._keepalive_period
+        self._nextping = time.time() + self._ping_period
+        self._ping_deadline = None
+        self._ping_id = 0
+        # wake() writes to this pair, so select in await_notification returns
+        self._wake_reader, self._wake_writer = socket.socketpair()
+        self._wake_reader.setblocking(False)
+        self._wake_writer.setblocking(False)
+
+    def _readable(self):
+        """True if the socket has data which can be read without waiting"""
+        sock = self._wrappedsock
+        # select can't see data the SSL layer has already decrypted
+        if hasattr(sock, 'pending') and sock.pending():
+            return True
+        (r, w, e) = select.select([sock], [], [], 0)
+        return bool(r)
 
     def _read_socket(self):
-        """read pending data from the socket, and send it to the XML parser.
-        return False if the socket is closed, True if it is ok"""
+        """read all pending data from the socket, and send it to the XML
+        parser. raises an exception if the socket is closed"""
         try:
             self._nextkeepalive = time.time() + self._keepalive_period
-            data = self._wrappedsock.recv(1024)
+            data = self._wrappedsock.recv(self._recv_size)
             if data is None or len(data) == 0:
                 # socket closed
                 raise Exception("xmpp socket closed")
+
+            # Anything from the server shows the connection is alive
+            self._nextping = time.time() + self._ping_period
+            self._ping_deadline = None
+
+            chunks = [data]
+            while self._readable():
+                data = self._wrappedsock.recv(self._recv_size)
+                if not data:
+                    # closed; the next read will notice
+                    break
+                chunks.append(data)
         except:
             self._connected = False
             raise
 
-        data = data.decode('utf-8')
-        LOGGER.debug('<<< %s' % data)
+        # The parser decodes the bytes itself, so a multibyte character
+        # split between two reads is not a problem.
+        data = b''.join(chunks)
+        LOGGER.debug('<<< %s' % data.decode('utf-8', 'replace'))
         self._xmlparser.feed(data)
 
     def _write_socket(self, msg):
@@ -120,13 +304,23 @@ class XmppConnection(object):
             self._read_socket()
 
     def _check_for_notification(self):
-        """Check for any notifications which have already been received"""
-        return(self._handler.get_elem() is not None)
+        """Check for any notifications which have already been received.
+        returns the set of printer ids they name, or None if there were no
+        notifications"""
+        return self._handler.get_notifications()
 
     def _send_keepalive(self):
         LOGGER.info("Sending XMPP keepalive")
         self._write_socket(" ")
 
+    def _send_ping(self):
+        LOGGER.debug("Sending XMPP ping")
+        self._ping_id += 1
+        self._write_socket(PING % self._ping_id)
+        now = time.time()
+        self._ping_deadline = now + self._ping_timeout
+        self._nextping = now + self._ping_period
+
     def connect(self, host, port, auth):
         """Establish a new connection to the XMPP server"""
         # first close any existing socket
@@ -135,64 +329,42 @@ class XmppConnection(object):
         LOGGER.info("Establishing connection to xmpp server %s:%i" %
                     (host, port))
         self._xmppsock = socket.socket()
+        self._xmppsock.settimeout(CONNECT_TIMEOUT)
+        set_tcp_keepalive(self._xmppsock)
         self._wrappedsock = self._xmppsock
-        raw_auth_string = '\0{0}\0{1}'.format(
-            auth.xmpp_jid,
-            auth.access_token
-        ).encode('utf-8')
-        auth_string = base64.b64encode(raw_auth_string).decode('utf-8')
+        auth_string = sasl_auth_string(auth)
 
         try:
-            self._wrappedsock = ssl.wrap_socket(self._xmppsock)
+            self._wrappedsock = ssl_context().wrap_socket(
+                self._xmppsock,
+                server_hostname=host,
+                session=self._tls_session,
+            )
             self._wrappedsock.connect((host, port))
+            if self._wrappedsock.session_reused:
+                LOGGER.info("Resumed TLS session with %s" % host)
 
             self._handler = XmppXmlHandler()
             self._xmlparser = XMLParser(target=self._handler)
 
-            # https://developers.google.com/cloud-print/docs/rawxmpp
-            self._msg(
-                '<stream:stream to="gmail.com" xml:lang="en" version="1.0" '
-                'xmlns:stream="http://etherx.jabber.org/streams" '
-                'xmlns="jabber:client">'
-            )
-            self._msg(
-                '<auth xmlns="urn:ietf:params:xml:ns:xmpp-sasl" '
-                'mechanism="X-OAUTH2">%s</auth>'
-                % auth_string
-            )
-            self._msg(
-                '<stream:stream to="gmail.com" xml:lang="en" version="1.0" '
-                'xmlns:stream="http://etherx.jabber.org/streams" '
-                'xmlns="jabber:client">'
-            )
-            iq = self._msg(
-                '<iq type="set" id="0">'
-                '<bind xmlns="urn:ietf:params:xml:ns:xmpp-bind">'
-                '<resource>cloud_print</resource>'
-                '</bind>'
-                '</iq>'
-            )
-            bare_jid = iq[0][0].text.split('/')[0]
-            self._msg(
-                '<iq type="set" id="2">'
-                '<session xmlns="urn:ietf:params:xml:ns:xmpp-session"/>'
-                '</iq>'
-            )
-            self._msg(
-                '<iq type="set" id="3" to="%s">'
-                '<subscribe xmlns="google:push">'
-                '<item channel="cloudprint.google.com" '
-                'from="cloudprint.google.com"/>'
-                '</subscribe>'
-                '</iq>'
-                % bare_jid
-            )
+            self._msg(STREAM_START)
+            self._msg(AUTH % auth_string)
+            self._msg(STREAM_START)
+            iq = self._msg(BIND)
+            self._msg(SESSION)
+            self._msg(SUBSCRIBE % bound_jid(iq))
+            # from here on, select tells us when to read
+            self._wrappedsock.settimeout(None)
         except:
             self.close()
             raise
 
         LOGGER.info("xmpp connection established")
         self._connected = True
+        self._nextping = time.time() + self._ping_period
+        self._ping_deadline = None
+        # Any session ticket has arrived by now; keep it for the next connect
+        self._tls_session = self._wrappedsock.session
 
     def close(self):
         """Close the connection to the XMPP server"""
@@ -207,13 +379,33 @@ class XmppConnection(object):
             self._nextkeepalive = 0
             self._wrappedsock = None
 
+    def wake(self):
+        """Make the current or next call to await_notification return None
+        right away. May be called from any thread."""
+        try:
+            self._wake_writer.send(b'\0')
+        except socket.error:
+            # the buffer is full of wakeups already
+            pass
+
+    def _clear_wakeups(self):
+        try:
+            while self._wake_reader.recv(4096):
+                pass
+        except socket.error:
+            # drained
+            pass
+
     def is_connected(self):
         """Check if we are connected to the XMPP server
         returns true if the connection is active; false otherwise"""
         return self._connected
 
     def await_notification(self, timeout):
-        """wait for a timeout or event notification"""
+        """wait for a timeout or event notification
+        returns None on timeout or wake(), or else the set of printer ids
+        named by the notifications; the set is empty if no printer could be
+        identified"""
         now = time.time()
 
         timeoutend = None
@@ -222,16 +414,22 @@ class XmppConnection(object):
 
         while True:
             try:
-                if self._check_for_notification():
-                    return True
+                printer_ids = self._check_for_notification()
+                if printer_ids is not None:
+                    return printer_ids
 
                 if timeoutend is not None and timeoutend - now <= 0:
                     # timeout
-                    return False
+                    return None
 
                 waittime = self._nextkeepalive - now
                 LOGGER.debug("%f seconds until next keepalive" % waittime)
 
+                if self._ping_deadline is not None:
+                    waittime = min(waittime, self._ping_deadline - now)
+                else:
+                    waittime = min(waittime, self._nextping - now)
+
                 if timeoutend is not None:
                     remaining = timeoutend - now
                     if remaining < waittime:
@@ -242,7 +440,12 @@ class XmppConnection(object):
                     waittime = 0
 
                 sock = self._wrappedsock
-                (r, w, e) = select.select([sock], [], [sock], waittime)
+                (r, w, e) = select.select(
+                    [sock, self._wake_reader],
+                    [],
+                    [sock],
+                    waittime,
+                )
 
                 now = time.time()
 
@@ -256,6 +459,20 @@ class XmppConnection(object):
                     LOGGER.warn("Error in xmpp connection")
                     raise Exception("xmpp connection errror")
 
+                if self._ping_deadline is not None:
+                    if self._ping_deadline - now <= 0:
+                        LOGGER.warning(
+                            "No answer to xmpp ping in %.0f seconds" %
+                            self._ping_timeout
+                        )
+                        raise Exception("xmpp connection is dead")
+                elif self._nextping - now <= 0:
+                    self._send_ping()
+
+                if self._wake_reader in r:
+                    self._clear_wakeups()
+                    return None
+
             except:
                 self.close()
                 raise
@@ -4,6 +4,8 @@ import requests as requests_lib
 
 import requests_mock
 
+from cloudprint.printerfilter import PrinterFilter
+
 
 @pytest.yield_fixture
 def requests():
@@ -18,14 +20,24 @@ def cpp(monkeypatch):
     def add_printer(name):
         printer = mock.Mock(name='cpp printer ' + name)
         printer.name = name
+        printer.ppd = 'ppd ' + name
+        printer.description = 'description ' + name
+        printer.is_current.return_value = False
         printers[name] = printer
         return printer
 
     cpp = mock.Mock(name='cpp')
     cpp.auth.session = requests_lib
     cpp.get_printers.side_effect = lambda: list(printers.values())
-    cpp.include = []
-    cpp.exclude = []
+    cpp.cached_printers.side_effect = cpp.get_printers.side_effect
+    cpp.fetch_jobs.side_effect = lambda printers: [
+        (printer, printer.get_jobs()) for printer in printers
+    ]
+    cpp.sleeptime = 3600.0
+    cpp.printer_filter = PrinterFilter()
+    cpp.spool_jobs = False
+    cpp.job_deadline = 600.0
+    cpp.acks = None
 
     def get_printer_info(cpp, name):
         try:
@@ -48,7 +60,7 @@ def cups():
     printers = {}
 
     def add_printer(name):
-        printers[name] = 1
+        printers[name] = {}
 
     cups = mock.Mock(name='cups')
     cups.getPrinters.side_effect = printers.copy
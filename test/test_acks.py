@@ -0,0 +1,147 @@
+import os
+import threading
+
+from tempfile import mkstemp as tempfile_mkstemp
+
+import pytest
+import requests
+
+from cloudprint import acks
+from cloudprint import retry
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(response=response)
+
+
+class Sender(object):
+    def __init__(self, errors=None):
+        self.sent = []
+        self.errors = errors or {}
+        self.lock = threading.Lock()
+
+    def __call__(self, job_id, status):
+        with self.lock:
+            self.sent.append((job_id, status))
+        error = self.errors.pop(job_id, None)
+        if error is not None:
+            raise error
+
+
+def test_put_and_flush(tmpdir):
+    send = Sender()
+    queue = acks.AckQueue(str(tmpdir.join('acks')), send)
+
+    queue.put('job_1', 'DONE')
+    queue.put('job_2', 'ERROR')
+    assert 'job_1' in queue
+    assert len(queue) == 2
+
+    assert queue.flush()
+    assert sorted(send.sent) == [('job_1', 'DONE'), ('job_2', 'ERROR')]
+    assert len(queue) == 0
+    assert 'job_1' not in queue
+
+
+def test_put_unsaved(tmpdir):
+    send = Sender()
+    queue = acks.AckQueue(str(tmpdir.join('missing', 'acks')), send)
+
+    queue.put('job_1', 'DONE')
+
+    assert 'job_1' in queue
+    assert queue.flush()
+    assert send.sent == [('job_1', 'DONE')]
+
+
+def test_survives_restart(tmpdir):
+    path = str(tmpdir.join('acks'))
+    queue = acks.AckQueue(path, Sender())
+    queue.put('job_1', 'DONE')
+
+    send = Sender()
+    queue = acks.AckQueue(path, send)
+    assert 'job_1' in queue
+    assert queue.flush()
+    assert send.sent == [('job_1', 'DONE')]
+
+    assert len(acks.AckQueue(path, Sender())) == 0
+
+
+def test_unreadable_file(tmpdir):
+    path = tmpdir.join('acks')
+    path.write('not json')
+
+    assert len(acks.AckQueue(str(path), Sender())) == 0
+
+
+def test_transient_failure_kept(tmpdir):
+    send = Sender({
+        'job_1': requests.ConnectionError(),
+        'job_2': http_error(404),
+    })
+    queue = acks.AckQueue(str(tmpdir.join('acks')), send)
+    queue.put('job_1', 'DONE')
+    queue.put('job_2', 'DONE')
+    queue.put('job_3', 'DONE')
+
+    assert not queue.flush()
+    assert 'job_1' in queue
+    assert 'job_2' not in queue
+    assert 'job_3' not in queue
+
+    assert queue.flush()
+    assert len(queue) == 0
+
+
+def test_newer_status_kept(tmpdir):
+    path = str(tmpdir.join('acks'))
+
+    def send(job_id, status):
+        # e.g. the job was retried and failed while its status was sent
+        queue.put(job_id, 'ERROR')
+    queue = acks.AckQueue(path, send)
+    queue.put('job_1', 'DONE')
+
+    queue.flush()
+
+    assert 'job_1' in queue
+
+
+def test_worker(tmpdir):
+    send = Sender({'job_1': requests.Timeout()})
+    queue = acks.AckQueue(
+        str(tmpdir.join('acks')),
+        send,
+        backoff=retry.Backoff(0, 0),
+    )
+    queue.start()
+
+    queue.put('job_1', 'DONE')
+
+    assert queue.wait(5)
+    assert send.sent == [('job_1', 'DONE'), ('job_1', 'DONE')]
+
+
+def test_save_failure_closes_file(tmpdir, monkeypatch):
+    fds = []
+
+    def mkstemp(**kwargs):
+        fd, path = tempfile_mkstemp(**kwargs)
+        fds.append(fd)
+        return fd, path
+    monkeypatch.setattr('cloudprint.acks.tempfile.mkstemp', mkstemp)
+
+    def fdopen(fd, mode):
+        raise OSError('out of memory')
+    monkeypatch.setattr('cloudprint.acks.os.fdopen', fdopen)
+
+    queue = acks.AckQueue(str(tmpdir.join('acks')), Sender())
+    queue.put('job_1', 'DONE')
+
+    assert 'job_1' in queue
+    with pytest.raises(OSError):
+        os.fstat(fds[0])
+    assert tmpdir.listdir() == []
@@ -0,0 +1,156 @@
+import asyncio
+import base64
+
+import mock
+import pytest
+
+from cloudprint import asyncxmpp
+
+
+SERVER_STREAM = (
+    '<stream:stream xmlns:stream="http://etherx.jabber.org/streams" '
+    'xmlns="jabber:client">'
+)
+FEATURES = '<stream:features/>'
+RESPONSES = [
+    SERVER_STREAM + FEATURES,
+    '<success xmlns="urn:ietf:params:xml:ns:xmpp-sasl"/>',
+    SERVER_STREAM + FEATURES,
+    '<iq type="result" id="0">'
+    '<bind xmlns="urn:ietf:params:xml:ns:xmpp-bind">'
+    '<jid>me@example.com/cloud_print</jid>'
+    '</bind>'
+    '</iq>',
+    '<iq type="result" id="2"/>',
+    '<iq type="result" id="3"/>',
+]
+
+
+def push(printer_id):
+    return (
+        '<message from="cloudprint.google.com">'
+        '<push:push channel="cloudprint.google.com" xmlns:push="google:push">'
+        '<push:data>%s</push:data>'
+        '</push:push>'
+        '</message>'
+    ) % base64.b64encode(printer_id.encode('utf-8')).decode('ascii')
+
+
+class FakeServer(object):
+    def __init__(self):
+        self.received = []
+        self.writer = None
+        self.subscribed = asyncio.Event()
+        self.closed = asyncio.Event()
+
+    async def handle(self, reader, writer):
+        self.writer = writer
+        for response in RESPONSES:
+            self.received.append((await reader.read(4096)).decode('utf-8'))
+            writer.write(response.encode('utf-8'))
+        self.subscribed.set()
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                self.closed.set()
+                return
+            self.received.append(data.decode('utf-8'))
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_connect_and_notify():
+    async def scenario():
+        fake = FakeServer()
+        server = await asyncio.start_server(fake.handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        auth = mock.Mock(xmpp_jid='me@example.com', access_token='token')
+
+        conn = asyncxmpp.AsyncXmppConnection(
+            keepalive_period=0.05,
+            ssl_context=False,
+        )
+        await conn.connect('127.0.0.1', port, auth)
+        await fake.subscribed.wait()
+        assert conn.is_connected()
+        assert 'mechanism="X-OAUTH2"' in fake.received[1]
+        assert 'to="me@example.com"' in fake.received[5]
+
+        assert await conn.await_notification(0.01) is None
+
+        fake.writer.write((push('printer-1') + push('printer-2')).encode())
+        assert await conn.await_notification(1) == set(
+            ['printer-1', 'printer-2']
+        )
+
+        # keepalives are sent while nobody is waiting on the connection
+        await asyncio.sleep(0.2)
+        assert any(not data.strip() for data in fake.received[6:])
+
+        await conn.close()
+        assert not conn.is_connected()
+        await asyncio.wait_for(fake.closed.wait(), 1)
+        server.close()
+        await server.wait_closed()
+
+    run(scenario())
+
+
+def test_ping_unanswered():
+    async def scenario():
+        fake = FakeServer()
+        server = await asyncio.start_server(fake.handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        auth = mock.Mock(xmpp_jid='me@example.com', access_token='token')
+
+        conn = asyncxmpp.AsyncXmppConnection(
+            ssl_context=False,
+            ping_period=0.05,
+            ping_timeout=0.05,
+        )
+        await conn.connect('127.0.0.1', port, auth)
+
+        with pytest.raises(Exception):
+            await conn.await_notification(1)
+        assert not conn.is_connected()
+        assert any('urn:xmpp:ping' in data for data in fake.received)
+
+        await asyncio.wait_for(fake.closed.wait(), 1)
+        server.close()
+        await server.wait_closed()
+
+    run(scenario())
+
+
+def test_notifications_merged():
+    async def scenario():
+        conn = asyncxmpp.AsyncXmppConnection(ssl_context=False)
+        conn._notifications = asyncio.Queue()
+
+        conn._notifications.put_nowait(set(['printer-1']))
+        conn._notifications.put_nowait(set(['printer-2']))
+        assert await conn.await_notification(1) == set(
+            ['printer-1', 'printer-2']
+        )
+
+        # a push which names no printer is for every printer
+        conn._notifications.put_nowait(set(['printer-1']))
+        conn._notifications.put_nowait(set())
+        conn._notifications.put_nowait(set(['printer-2']))
+        assert await conn.await_notification(1) == set()
+
+        conn.wake()
+        assert await conn.await_notification(1) is None
+
+        # a wakeup among notifications is answered by returning them
+        conn._notifications.put_nowait(set(['printer-1']))
+        conn.wake()
+        assert await conn.await_notification(1) == set(['printer-1'])
+
+    run(scenario())
@@ -1,6 +1,15 @@
 import datetime
 import json
+import os
+import socket
+import threading
+import time
 
+from tempfile import mkstemp as tempfile_mkstemp
+
+import pytest
+
+from cloudprint import cloudprint
 from cloudprint.cloudprint import (
     CLIENT_ID,
     PRINT_CLOUD_URL,
@@ -116,3 +125,208 @@ def test_load(tmpdir, requests):
     assert auth.email == 'example@example.com'
     assert auth.xmpp_jid == 'my_xmpp'
     assert auth.refresh_token == 'refresh_123'
+
+
+def test_session_reused(tmpdir, requests):
+    requests.post(
+        'https://accounts.google.com/o/oauth2/token',
+        json={
+            'access_token': 'access_token-456def',
+            'expires_in': 3600,
+        }
+    )
+
+    auth_path = tmpdir.join('auth')
+    auth = CloudPrintAuth(str(auth_path))
+    auth._access_token = 'access_token-123abc'
+    auth.refresh_token = 'refresh-123abc'
+    auth.exp_time = datetime.datetime.now() + datetime.timedelta(hours=1)
+
+    session = auth.session
+    assert auth.session is session
+    assert session.headers['Authorization'] == 'Bearer access_token-123abc'
+
+    auth.refresh()
+
+    assert auth.session is session
+    assert session.headers['Authorization'] == 'Bearer access_token-456def'
+
+
+def test_access_token_background_refresh(tmpdir, requests):
+    auth_path = tmpdir.join('auth')
+    auth = CloudPrintAuth(str(auth_path))
+    auth._access_token = 'access_token-123abc'
+    auth.refresh_token = 'refresh-123abc'
+    auth.exp_time = datetime.datetime.now() - datetime.timedelta(minutes=1)
+    auth._valid_until = (
+        datetime.datetime.now() + datetime.timedelta(minutes=14)
+    )
+    auth.background_refresh = True
+
+    assert auth.access_token == 'access_token-123abc'
+    assert not requests.called
+
+
+def test_access_token_expired_blocks(tmpdir, requests):
+    requests.post(
+        'https://accounts.google.com/o/oauth2/token',
+        json={
+            'access_token': 'access_token-456def',
+            'expires_in': 3600,
+        }
+    )
+
+    auth_path = tmpdir.join('auth')
+    auth = CloudPrintAuth(str(auth_path))
+    auth._access_token = 'dead'
+    auth.refresh_token = 'refresh-123abc'
+    auth.exp_time = datetime.datetime.fromtimestamp(0)
+    auth._valid_until = datetime.datetime.fromtimestamp(0)
+    auth.background_refresh = True
+
+    assert auth.access_token == 'access_token-456def'
+    assert requests.call_count == 1
+
+
+def test_load_reuses_saved_token(tmpdir, requests):
+    auth_path = tmpdir.join('auth')
+    with auth_path.open('w') as auth_file:
+        json.dump(
+            {
+                'guid': 'guid123',
+                'email': 'example@example.com',
+                'xmpp_jid': 'my_xmpp',
+                'refresh_token': 'refresh_123',
+                'access_token': 'access_token-123abc',
+                'expires': time.time() + 3600,
+            },
+            auth_file,
+        )
+
+    auth = CloudPrintAuth(str(auth_path))
+    auth.load()
+
+    assert auth.access_token == 'access_token-123abc'
+    assert not requests.called
+
+
+def test_load_refreshes_stale_token(tmpdir, requests):
+    requests.post(
+        'https://accounts.google.com/o/oauth2/token',
+        json={
+            'access_token': 'access_token-456def',
+            'expires_in': 3600,
+        }
+    )
+
+    auth_path = tmpdir.join('auth')
+    with auth_path.open('w') as auth_file:
+        json.dump(
+            {
+                'guid': 'guid123',
+                'email': 'example@example.com',
+                'xmpp_jid': 'my_xmpp',
+                'refresh_token': 'refresh_123',
+                'access_token': 'access_token-123abc',
+                'expires': time.time() + 60,
+            },
+            auth_file,
+        )
+
+    auth = CloudPrintAuth(str(auth_path))
+    auth.load()
+
+    assert auth.access_token == 'access_token-456def'
+    with auth_path.open() as auth_file:
+        assert json.load(auth_file)['access_token'] == 'access_token-456def'
+
+
+def test_timeouts(tmpdir, requests):
+    requests.post(
+        'https://accounts.google.com/o/oauth2/token',
+        json={
+            'access_token': 'access_token-123abc',
+            'expires_in': 3600,
+        }
+    )
+    requests.get('http://example.com/')
+
+    auth_path = tmpdir.join('auth')
+    auth = CloudPrintAuth(str(auth_path), timeout=(1.0, 2.0))
+    auth._access_token = 'dead'
+    auth.refresh_token = 'refresh-123abc'
+    auth.exp_time = datetime.datetime.fromtimestamp(0)
+
+    auth.session.get('http://example.com/')
+    auth.session.get('http://example.com/', timeout=5.0)
+
+    assert [r.timeout for r in requests.request_history] == [
+        (1.0, 2.0), (1.0, 2.0), 5.0,
+    ]
+
+
+def blocked_get(auth, url, errors):
+    try:
+        auth.session.get(url)
+    except Exception as error:
+        errors.append(error)
+
+
+def test_close_connections(tmpdir):
+    auth = CloudPrintAuth(str(tmpdir.join('auth')), timeout=(5.0, 30.0))
+    auth._access_token = 'access_token-123abc'
+    auth.exp_time = datetime.datetime.now() + datetime.timedelta(hours=1)
+
+    # a server which reads requests and never answers them
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(2)
+    url = 'http://127.0.0.1:%d/' % server.getsockname()[1]
+
+    errors = []
+    stuck = threading.Thread(target=blocked_get, args=(auth, url, errors))
+    other = threading.Thread(target=blocked_get, args=(auth, url, errors))
+    clients = []
+    for thread in (stuck, other):
+        thread.start()
+        client, _ = server.accept()
+        client.recv(4096)
+        clients.append(client)
+
+    cloudprint.close_connections(stuck.ident)
+
+    stuck.join(5)
+    assert not stuck.is_alive()
+    assert len(errors) == 1
+    # only the connection of the stuck thread was closed
+    assert other.is_alive()
+
+    clients[1].sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')
+    other.join(5)
+    assert not other.is_alive()
+    assert len(errors) == 1
+
+    for sock in clients + [server]:
+        sock.close()
+
+
+def test_save_failure_closes_file(tmpdir, monkeypatch):
+    auth = CloudPrintAuth(str(tmpdir.join('auth')))
+    fds = []
+
+    def mkstemp(**kwargs):
+        fd, path = tempfile_mkstemp(**kwargs)
+        fds.append(fd)
+        return fd, path
+    monkeypatch.setattr('cloudprint.cloudprint.tempfile.mkstemp', mkstemp)
+
+    def fdopen(fd, mode):
+        raise OSError('out of memory')
+    monkeypatch.setattr('cloudprint.cloudprint.os.fdopen', fdopen)
+
+    with pytest.raises(OSError):
+        auth.save()
+
+    with pytest.raises(OSError):
+        os.fstat(fds[0])
+    assert tmpdir.listdir() == []
@@ -0,0 +1,85 @@
+import threading
+import time
+
+import mock
+
+from cloudprint.jobs import JobDispatcher
+
+
+def printer(name):
+    printer = mock.Mock(name='printer ' + name)
+    printer.name = name
+    return printer
+
+
+def test_dispatch():
+    handler = mock.Mock(name='handler')
+    connection_factory = mock.Mock(name='connection_factory')
+    dispatcher = JobDispatcher(handler, connection_factory)
+    printer_1 = printer('printer 1')
+
+    assert dispatcher.submit(printer_1, {'id': 'job_1'})
+    assert dispatcher.wait(5)
+
+    handler.assert_called_with(
+        connection_factory.return_value,
+        printer_1,
+        {'id': 'job_1'},
+    )
+    assert dispatcher.pending() == 0
+
+
+def test_duplicate_job():
+    release = threading.Event()
+    handler = mock.Mock(side_effect=lambda *args: release.wait(5))
+    dispatcher = JobDispatcher(handler, mock.Mock())
+    printer_1 = printer('printer 1')
+
+    assert dispatcher.submit(printer_1, {'id': 'job_1'})
+    assert not dispatcher.submit(printer_1, {'id': 'job_1'})
+    assert dispatcher.is_active('job_1')
+
+    release.set()
+    assert dispatcher.wait(5)
+    assert handler.call_count == 1
+    assert not dispatcher.is_active('job_1')
+
+
+def test_per_printer_order():
+    printed = []
+    release = threading.Event()
+
+    def handler(connection, printer, job):
+        if job['id'] == 'slow':
+            release.wait(5)
+        printed.append(job['id'])
+
+    dispatcher = JobDispatcher(handler, mock.Mock(), max_workers=4)
+    slow_printer = printer('slow printer')
+    fast_printer = printer('fast printer')
+
+    dispatcher.submit(slow_printer, {'id': 'slow'})
+    for i in range(3):
+        dispatcher.submit(slow_printer, {'id': 'slow_%d' % i})
+        dispatcher.submit(fast_printer, {'id': 'fast_%d' % i})
+
+    # The fast printer isn't held up by the slow one
+    for _ in range(500):
+        if len(printed) == 3:
+            break
+        time.sleep(0.01)
+    assert printed == ['fast_0', 'fast_1', 'fast_2']
+
+    release.set()
+    assert dispatcher.wait(5)
+    assert printed[3:] == ['slow', 'slow_0', 'slow_1', 'slow_2']
+
+
+def test_handler_error():
+    handler = mock.Mock(side_effect=Exception('boom'))
+    dispatcher = JobDispatcher(handler, mock.Mock())
+
+    dispatcher.submit(printer('printer 1'), {'id': 'job_1'})
+
+    assert dispatcher.wait(5)
+    assert dispatcher.pending() == 0
@@ -0,0 +1,53 @@
+from cloudprint import poll
+
+
+def test_initial():
+    assert poll.AdaptivePoller(30, 3600).interval == 3600
+    assert poll.AdaptivePoller(30, 3600, initial=10).interval == 30
+
+
+def test_unannounced_jobs_shrink():
+    poller = poll.AdaptivePoller(30, 3600, initial=480)
+
+    poller.timed_out()
+    poller.swept(2, announced=False)
+    assert poller.interval == 240
+
+    for _ in range(10):
+        poller.timed_out()
+        poller.swept(1, announced=False)
+    assert poller.interval == 30
+
+
+def test_quiet_polls_grow():
+    poller = poll.AdaptivePoller(30, 3600, initial=30)
+
+    for _ in range(3):
+        poller.timed_out()
+        poller.swept(0, announced=False)
+    assert poller.interval == 240
+
+    for _ in range(10):
+        poller.timed_out()
+        poller.swept(0, announced=False)
+    assert poller.interval == 3600
+
+
+def test_announced_jobs_grow():
+    poller = poll.AdaptivePoller(30, 3600, initial=30)
+
+    poller.swept(1, announced=True)
+    assert poller.interval == 60
+
+    # a notification that finds nothing new says nothing either way
+    poller.swept(0, announced=True)
+    assert poller.interval == 60
+
+
+def test_sweep_without_timeout():
+    poller = poll.AdaptivePoller(30, 3600, initial=480)
+
+    # e.g. the first sweep at startup, which finds jobs queued while we
+    # were away
+    poller.swept(5, announced=False)
+    assert poller.interval == 480
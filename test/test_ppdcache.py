@@ -0,0 +1,87 @@
+import hashlib
+
+from cloudprint.ppdcache import PPDCache
+
+
+def test_get_put():
+    cache = PPDCache(100)
+
+    assert cache.get('printer', 1) is None
+
+    cache.put('printer', 1, 'ppd text')
+
+    assert cache.get('printer', 1) == 'ppd text'
+    assert cache.get('printer', 2) is None
+    assert cache.get('other', 1) is None
+
+
+def test_digest():
+    cache = PPDCache(100)
+    cache.put('printer', 1, 'ppd text')
+
+    assert cache.digest('ppd text') == hashlib.sha1(b'ppd text').hexdigest()
+    assert cache.digest('other') == hashlib.sha1(b'other').hexdigest()
+
+
+def test_digest_shared_ppd(monkeypatch):
+    cache = PPDCache(100)
+    cache.put('a', 1, 'ppd text')
+    cache.put('b', 1, 'ppd text')
+    cache.put('a', 2, 'new ppd text')
+
+    monkeypatch.setattr('cloudprint.ppdcache.sha1', None)
+    assert cache.digest('ppd text') == hashlib.sha1(b'ppd text').hexdigest()
+
+
+def test_new_version_replaces_old():
+    cache = PPDCache(100)
+    cache.put('printer', 1, 'ppd 1')
+    cache.put('printer', 2, 'ppd 2')
+
+    assert cache.get('printer', 1) is None
+    assert cache.get('printer', 2) == 'ppd 2'
+
+
+def test_lru_eviction():
+    cache = PPDCache(10)
+    cache.put('a', 1, 'aaaa')
+    cache.put('b', 1, 'bbbb')
+    cache.get('a', 1)
+    cache.put('c', 1, 'cccc')
+
+    assert cache.get('a', 1) == 'aaaa'
+    assert cache.get('b', 1) is None
+    assert cache.get('c', 1) == 'cccc'
+
+
+def test_too_large():
+    cache = PPDCache(3)
+    cache.put('a', 1, 'aaaa')
+
+    assert cache.get('a', 1) is None
+
+
+def test_disk(tmpdir):
+    cache = PPDCache(100, str(tmpdir.join('cache')))
+    cache.put('printer', 1, u'ppd text ☃')
+
+    cache = PPDCache(100, str(tmpdir.join('cache')))
+
+    assert cache.get('printer', 1) == u'ppd text ☃'
+    assert cache.get('printer', 2) is None
+
+
+def test_disk_new_version_replaces_old(tmpdir):
+    directory = tmpdir.join('cache')
+    cache = PPDCache(100, str(directory))
+    cache.put('printer', 1, 'ppd 1')
+    cache.put('printer', 2, 'ppd 2')
+    cache.put('other', 1, 'other ppd')
+
+    assert len(directory.listdir()) == 2
+
+    cache = PPDCache(100, str(directory))
+
+    assert cache.get('printer', 1) is None
+    assert cache.get('printer', 2) == 'ppd 2'
+    assert cache.get('other', 1) == 'other ppd'
@@ -49,6 +49,8 @@ def test_get_printers(proxy, requests, remove_site):
                 {
                     'id': '1',
                     'name': 'printer 1',
+                    'capsHash': 'abc123',
+                    'description': 'description 1',
                 },
                 {
                     'id': '2',
@@ -62,6 +64,8 @@ def test_get_printers(proxy, requests, remove_site):
 
     assert printers[0].id == '1'
     assert remove_site(printers[0].name) == 'printer 1'
+    assert printers[0].caps_hash == 'abc123'
+    assert printers[0].description == 'description 1'
     assert printers[1].id == '2'
     assert remove_site(printers[1].name) == 'printer 2'
 
@@ -166,3 +170,109 @@ def test_fail_job(proxy, requests):
     data = parse.parse_qs(requests.request_history[0].text)
     assert data['jobid'][0] == '1'
     assert data['status'][0] == 'ERROR'
+
+
+def test_finish_job_queued(proxy, requests):
+    proxy.acks = mock.Mock(name='acks')
+
+    proxy.finish_job('1')
+    proxy.fail_job('2')
+
+    assert proxy.acks.put.call_args_list == [
+        mock.call('1', 'DONE'),
+        mock.call('2', 'ERROR'),
+    ]
+    assert not requests.called
+
+
+def test_fetch_jobs_batched(proxy, requests):
+    proxy.auth.guid = 'guid123'
+    requests.post(
+        PRINT_CLOUD_URL + 'fetch',
+        json={
+            'jobs': [
+                {'id': 'job1', 'printerid': '1'},
+                {'id': 'job2', 'printerid': '2'},
+                {'id': 'job3', 'printerid': '1'},
+            ]
+        }
+    )
+    printer_1 = mock.Mock(id='1')
+    printer_2 = mock.Mock(id='2')
+    printer_3 = mock.Mock(id='3')
+
+    jobs = proxy.fetch_jobs([printer_1, printer_2, printer_3])
+
+    assert requests.call_count == 1
+    data = parse.parse_qs(requests.request_history[0].text)
+    assert data['proxy'][0] == 'guid123'
+    assert 'printerid' not in data
+    assert jobs == [
+        (printer_1, [{'id': 'job1', 'printerid': '1'},
+                     {'id': 'job3', 'printerid': '1'}]),
+        (printer_2, [{'id': 'job2', 'printerid': '2'}]),
+        (printer_3, []),
+    ]
+
+
+def test_fetch_jobs_fallback(proxy, requests):
+    requests.post(
+        PRINT_CLOUD_URL + 'fetch',
+        json={
+            'success': False,
+            'errorCode': 7,
+        }
+    )
+    printer_1 = mock.Mock(id='1')
+    printer_1.get_jobs.return_value = ['job1']
+    printer_2 = mock.Mock(id='2')
+    printer_2.get_jobs.return_value = ['job2']
+
+    jobs = proxy.fetch_jobs([printer_1, printer_2])
+
+    assert jobs == [(printer_1, ['job1']), (printer_2, ['job2'])]
+    assert not proxy.batch_fetch
+
+
+@pytest.mark.parametrize('response', [
+    {'json': {'success': False, 'errorCode': 8, 'message': 'Slow down'}},
+    {'status_code': 503},
+])
+def test_fetch_jobs_transient_error(proxy, requests, response):
+    requests.post(PRINT_CLOUD_URL + 'fetch', **response)
+    printer_1 = mock.Mock(id='1')
+    printer_2 = mock.Mock(id='2')
+
+    with pytest.raises(Exception):
+        proxy.fetch_jobs([printer_1, printer_2])
+
+    assert proxy.batch_fetch
+    assert not printer_1.get_jobs.called
+
+
+def test_cached_printers(proxy, requests):
+    requests.post(
+        PRINT_CLOUD_URL + 'list',
+        json={
+            'printers': [
+                {
+                    'id': '1',
+                    'name': 'printer 1',
+                },
+            ]
+        },
+    )
+    requests.post(
+        PRINT_CLOUD_URL + 'delete',
+        status_code=200,
+    )
+
+    printers = proxy.cached_printers()
+
+    assert proxy.cached_printers() is printers
+    assert requests.call_count == 1
+
+    proxy.delete_printer('1')
+
+    assert proxy.cached_printers() is not printers
+    assert requests.call_count == 3
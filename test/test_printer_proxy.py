@@ -1,3 +1,5 @@
+import hashlib
+
 import mock
 import pytest
 
@@ -44,3 +46,17 @@ def test_delete(cpp, printer_proxy):
     cpp.delete_printer.assert_called_with(
         printer_proxy.id,
     )
+
+
+def test_is_current(cpp):
+    printer_proxy = PrinterProxy(
+        cpp=cpp,
+        printer_id='1',
+        name='printer 1',
+        caps_hash=hashlib.sha1(b'printer_ppd').hexdigest(),
+        description='printer_description',
+    )
+
+    assert printer_proxy.is_current('printer_description', 'printer_ppd')
+    assert not printer_proxy.is_current('printer_description', 'new_ppd')
+    assert not printer_proxy.is_current('new_description', 'printer_ppd')
@@ -0,0 +1,61 @@
+import pytest
+
+from cloudprint.printerfilter import PrinterFilter
+
+
+def test_default():
+    printer_filter = PrinterFilter()
+
+    assert printer_filter.matches('anything')
+    assert printer_filter.explain('anything') == (True, 'included by default')
+
+
+def test_include():
+    printer_filter = PrinterFilter(include=['lp', '2up'])
+
+    assert printer_filter.filter(['lp', 'lp2', '2up', 'other', 'my-lp']) == \
+        set(['lp', 'lp2', '2up'])
+    assert printer_filter.explain('2up') == (True, 'included by 2up')
+    assert printer_filter.explain('other') == (
+        False,
+        'matches no include pattern',
+    )
+
+
+def test_exclude():
+    printer_filter = PrinterFilter(include=['lp'], exclude=['lp-gcp'])
+
+    assert printer_filter.matches('lp1')
+    assert not printer_filter.matches('lp-gcp-1')
+    assert printer_filter.explain('lp-gcp-1') == (False, 'excluded by lp-gcp')
+
+
+def test_duplicate_group_names():
+    printer_filter = PrinterFilter(include=['(?P<a>lp)', '(?P<a>2up)'])
+
+    assert printer_filter.matches('2up')
+    assert not printer_filter.matches('other')
+
+
+def test_numbered_backreference():
+    printer_filter = PrinterFilter(include=['(x)y', r'(a)\1'])
+
+    assert printer_filter.matches('xy')
+    assert printer_filter.matches('aa')
+    assert not printer_filter.matches('ab')
+
+
+def test_invalid_pattern():
+    with pytest.raises(ValueError) as error:
+        PrinterFilter(include=['lp'], exclude=['lp['])
+
+    assert 'lp[' in str(error.value)
+
+
+def test_site_names():
+    printer_filter = PrinterFilter(site='site.1')
+
+    assert printer_filter.remote_name('lp') == 'site.1-lp'
+    assert printer_filter.local_name('site.1-lp') == 'lp'
+    assert printer_filter.local_name('site11-lp') == 'site11-lp'
+    assert PrinterFilter().remote_name('lp') == 'lp'
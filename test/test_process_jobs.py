@@ -1,7 +1,16 @@
+import datetime
+import os
+import threading
+import time
+
 import mock
 import pytest
 
+from cloudprint import acks
 from cloudprint import cloudprint
+from cloudprint import jobs
+from cloudprint import poll
+from cloudprint import retry
 
 
 @pytest.fixture
@@ -11,9 +20,24 @@ def xmpp_conn(monkeypatch):
     return XmppConnection.return_value
 
 
-def test_print(requests, cups, cpp, xmpp_conn):
-    cloudprint.num_retries = 0
+@pytest.fixture
+def cpp(cpp):
+    cpp.retries = retry.RetryQueue(
+        cloudprint.RETRIES,
+        retry.Backoff(0, 0),
+        permanent=cloudprint.PERMANENT_ERRORS,
+    )
+    return cpp
+
+
+@pytest.fixture
+def cups(cups):
+    cups.startDocument.return_value = cloudprint.cups.HTTP_CONTINUE
+    cups.writeRequestData.return_value = cloudprint.cups.HTTP_CONTINUE
+    return cups
+
 
+def test_print(requests, cups, cpp):
     printer = cpp.test_add_printer('printer')
     printer.get_jobs.return_value = [{
         'fileUrl': 'http://print_job.pdf',
@@ -23,7 +47,52 @@ def test_print(requests, cups, cpp, xmpp_conn):
         'ownerId': 'owner@example.com'
     }]
 
-    xmpp_conn.is_connected.return_value = True
+    requests.get('http://print_job.pdf', text='This is a PDF')
+    requests.get(
+        'http://ticket',
+        json={
+            'request': '',
+            'a': 1,
+            'b': 2,
+        },
+    )
+
+    cloudprint.sweep_jobs(cups, cpp)
+
+    cups.createJob.assert_called_with(
+        'printer',
+        '*' * 255,
+        {
+            'a': '1',
+            'b': '2',
+            'job-originating-user-name': 'owner@example.com',
+        },
+    )
+    cups.startDocument.assert_called_with(
+        'printer',
+        cups.createJob.return_value,
+        '*' * 255,
+        cloudprint.cups.CUPS_FORMAT_AUTO,
+        1,
+    )
+    cups.writeRequestData.assert_called_with(b'This is a PDF', 13)
+    cups.finishDocument.assert_called_with('printer')
+    assert not cups.printFile.called
+    cpp.finish_job.assert_called_with('job_1')
+    assert 'job_1' not in cpp.retries
+
+
+def test_print_spooled(requests, cups, cpp):
+    cpp.spool_jobs = True
+
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = [{
+        'fileUrl': 'http://print_job.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': '*' * 300,
+        'id': 'job_1',
+        'ownerId': 'owner@example.com'
+    }]
 
     requests.get('http://print_job.pdf', text='This is a PDF')
     requests.get(
@@ -34,8 +103,12 @@ def test_print(requests, cups, cpp, xmpp_conn):
             'b': 2,
         },
     )
+    spooled = []
+    cups.printFile.side_effect = (
+        lambda name, path, title, options: spooled.append(path)
+    )
 
-    cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
+    cloudprint.sweep_jobs(cups, cpp)
 
     cups.printFile.assert_called_with(
         'printer',
@@ -47,14 +120,36 @@ def test_print(requests, cups, cpp, xmpp_conn):
             'job-originating-user-name': 'owner@example.com',
         },
     )
+    assert not cups.createJob.called
+    assert not os.path.exists(spooled[0])
     cpp.finish_job.assert_called_with('job_1')
-    assert xmpp_conn.await_notification.called
-    assert cloudprint.num_retries == 0
 
 
-def test_retry(requests, cups, cpp, xmpp_conn):
-    cloudprint.num_retries = 0
+def test_status_failure_not_reprinted(requests, cups, cpp):
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = [{
+        'fileUrl': 'http://print_job.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': 'title',
+        'id': 'job_1',
+        'ownerId': 'owner@example.com'
+    }]
+    requests.get('http://print_job.pdf', text='This is a PDF')
+    requests.get('http://ticket', json={})
+    requests.post(cloudprint.PRINT_CLOUD_URL + 'control', status_code=500)
+    cpp.finish_job.side_effect = cloudprint.CloudPrintProxy(
+        cpp.auth,
+    ).finish_job
+
+    cloudprint.sweep_jobs(cups, cpp)
+
+    assert cups.finishDocument.call_count == 1
+    assert cpp.finish_job.call_count == 1
+    assert 'job_1' not in cpp.retries
+    assert not cpp.fail_job.called
+
 
+def test_retry(requests, cups, cpp):
     printer = cpp.test_add_printer('printer')
     printer.get_jobs.return_value = [{
         'fileUrl': 'http://print_job.pdf',
@@ -66,14 +161,13 @@ def test_retry(requests, cups, cpp, xmpp_conn):
 
     requests.get(url='http://print_job.pdf', status_code=500)
 
-    cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
-
-    assert cloudprint.num_retries == 1
+    cloudprint.sweep_jobs(cups, cpp)
 
+    assert 'job_1' in cpp.retries
+    assert not cpp.fail_job.called
 
-def test_failed(requests, cups, cpp, xmpp_conn):
-    cloudprint.num_retries = 0
 
+def test_failed(requests, cups, cpp):
     printer = cpp.test_add_printer('printer')
     printer.get_jobs.return_value = [{
         'fileUrl': 'http://print_job.pdf',
@@ -86,7 +180,374 @@ def test_failed(requests, cups, cpp, xmpp_conn):
     requests.get(url='http://print_job.pdf', status_code=500)
 
     for _ in range(cloudprint.RETRIES + 1):
-        cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
+        cloudprint.sweep_jobs(cups, cpp)
+
+    cpp.fail_job.assert_called_with('job_1')
+    assert 'job_1' not in cpp.retries
+
+
+def test_retry_refused(cups, cpp):
+    printer = cpp.test_add_printer('printer')
+    job = {'id': 'job_1', 'title': 'title'}
+    printer.get_jobs.return_value = [job]
+    cpp.retries.failed(printer, job, IOError('connection reset'))
+    dispatcher = mock.Mock(name='dispatcher')
+
+    # the last attempt has not left the dispatcher yet
+    dispatcher.submit.return_value = False
+    cloudprint.sweep_jobs(cups, cpp, None, dispatcher)
+
+    assert 'job_1' in cpp.retries
+    assert cpp.retries.next_delay() == 0
+
+    dispatcher.submit.return_value = True
+    dispatcher.submit.reset_mock()
+    cloudprint.sweep_jobs(cups, cpp, None, dispatcher)
+
+    dispatcher.submit.assert_called_once_with(printer, job)
+
+
+def test_targeted_fetch(requests, cups, cpp):
+    printer_1 = cpp.test_add_printer('printer 1')
+    printer_1.id = '1'
+    printer_1.get_jobs.return_value = []
+    printer_2 = cpp.test_add_printer('printer 2')
+    printer_2.id = '2'
+    printer_2.get_jobs.return_value = []
+
+    cloudprint.sweep_jobs(cups, cpp)
+
+    assert printer_1.get_jobs.called
+    assert printer_2.get_jobs.called
+
+    printer_1.get_jobs.reset_mock()
+    printer_2.get_jobs.reset_mock()
+
+    cloudprint.sweep_jobs(cups, cpp, set(['2']))
+
+    assert not printer_1.get_jobs.called
+    assert printer_2.get_jobs.called
+
+
+def test_dispatch(requests, cups, cpp):
+    printer = cpp.test_add_printer('printer')
+    job = {
+        'fileUrl': 'http://print_job.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': 'title',
+        'id': 'job_1',
+        'ownerId': 'owner@example.com'
+    }
+    printer.get_jobs.return_value = [job]
+    dispatcher = mock.Mock(name='dispatcher')
+
+    cloudprint.sweep_jobs(cups, cpp, None, dispatcher)
+
+    dispatcher.submit.assert_called_with(printer, job)
+    assert not cups.printFile.called
+
+
+def test_permanent_failure(requests, cups, cpp):
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = [{
+        'fileUrl': 'http://print_job.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': 'title',
+        'id': 'job_1',
+        'ownerId': 'owner@example.com'
+    }]
+
+    requests.get('http://print_job.pdf', text='This is a PDF')
+    requests.get('http://ticket', json={})
+    cups.createJob.side_effect = cloudprint.cups.IPPError(0, 'bad document')
+
+    cloudprint.sweep_jobs(cups, cpp)
 
     cpp.fail_job.assert_called_with('job_1')
-    assert cloudprint.num_retries == 0
+    assert 'job_1' not in cpp.retries
+
+
+def test_retry_waits(requests, cups, cpp):
+    cpp.retries.backoff = retry.Backoff(60, 60, jitter=0)
+
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = [{
+        'fileUrl': 'http://print_job.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': 'title',
+        'id': 'job_1',
+        'ownerId': 'owner@example.com'
+    }]
+
+    requests.get(url='http://print_job.pdf', status_code=500)
+
+    cloudprint.sweep_jobs(cups, cpp)
+    cloudprint.sweep_jobs(cups, cpp)
+
+    downloads = [
+        r for r in requests.request_history if r.hostname == 'print_job.pdf'
+    ]
+    assert len(downloads) == 1
+    assert 0 < cpp.retries.next_delay() <= 60
+
+
+def test_debounce_merges_notifications(xmpp_conn):
+    xmpp_conn.await_notification.side_effect = [
+        set(['printer_1']),
+        set(['printer_2', 'printer_1']),
+        None,
+    ]
+
+    printer_ids = cloudprint.await_notifications(xmpp_conn, 10, 1000)
+
+    assert printer_ids == set(['printer_1', 'printer_2'])
+    assert xmpp_conn.await_notification.call_count == 3
+    assert xmpp_conn.await_notification.call_args[0][0] <= 1.0
+
+
+def test_debounce_unknown_printer(xmpp_conn):
+    xmpp_conn.await_notification.side_effect = [
+        set(['printer_1']),
+        set(),
+        None,
+    ]
+
+    assert cloudprint.await_notifications(xmpp_conn, 10, 1000) == set()
+
+
+def test_no_debounce(xmpp_conn):
+    xmpp_conn.await_notification.return_value = set(['printer_1'])
+
+    assert cloudprint.await_notifications(xmpp_conn, 10) == set(['printer_1'])
+    assert xmpp_conn.await_notification.call_count == 1
+
+
+def test_adaptive_poll(requests, cups, cpp):
+    poller = poll.AdaptivePoller(30, 3600, initial=480)
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = []
+
+    cloudprint.sweep_jobs(cups, cpp, poller=poller)
+    assert poller.interval == 480
+
+    printer.get_jobs.return_value = [{
+        'fileUrl': 'http://print_job.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': 'title',
+        'id': 'job_1',
+        'ownerId': 'owner@example.com'
+    }]
+    requests.get(url='http://print_job.pdf')
+    requests.get(url='http://ticket', json={})
+
+    poller.timed_out()
+    cloudprint.sweep_jobs(cups, cpp, poller=poller)
+    assert poller.interval == 240
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def job_loop(cups, cpp, xmpp_conn, monkeypatch, **kwargs):
+    monkeypatch.setattr(
+        'cloudprint.cloudprint.remove_stale_spool_files',
+        mock.Mock(),
+    )
+    cups.createSubscription.side_effect = cloudprint.cups.IPPError
+    cpp.sleeptime = 60.0
+    cpp.auth.exp_time = datetime.datetime.now() + datetime.timedelta(hours=1)
+
+    clock = Clock()
+
+    def await_notification(timeout):
+        clock.sleep(timeout)
+        return None
+    xmpp_conn.await_notification.side_effect = await_notification
+
+    loop = cloudprint.JobLoop(
+        cups, cpp, xmpp_conn, clock=clock, sleep=clock.sleep, **kwargs
+    )
+    loop.start()
+    return loop, clock
+
+
+def test_job_loop_polls(cups, cpp, xmpp_conn, monkeypatch):
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = []
+    loop, clock = job_loop(cups, cpp, xmpp_conn, monkeypatch)
+
+    while clock.now < 60:
+        loop.timers.run_once()
+    loop.timers.run_pending()
+
+    assert cpp.fetch_jobs.call_count == 2
+    # woken for the printer resync, then for the poll
+    assert [c[0][0] for c in xmpp_conn.await_notification.call_args_list] == [
+        30.0, 30.0,
+    ]
+    assert xmpp_conn.connect.call_count == 1
+    assert cpp.auth.refresh_if_stale.call_count == 1
+    assert cpp.retries.on_failed == loop.wake
+
+
+def test_job_loop_notification(cups, cpp, xmpp_conn, monkeypatch):
+    printer_1 = cpp.test_add_printer('printer 1')
+    printer_1.id = 'printer_1'
+    printer_2 = cpp.test_add_printer('printer 2')
+    printer_2.id = 'printer_2'
+    loop, clock = job_loop(cups, cpp, xmpp_conn, monkeypatch)
+    loop.timers.run_pending()
+
+    xmpp_conn.await_notification.side_effect = [set(['printer_2'])]
+    loop.timers.run_once()
+    loop.timers.run_pending()
+
+    cpp.fetch_jobs.assert_called_with([printer_2])
+    assert clock.now == 0
+
+
+def test_job_loop_reconnects(cups, cpp, xmpp_conn, monkeypatch):
+    cpp.test_add_printer('printer').get_jobs.return_value = []
+    xmpp_conn.is_connected.return_value = False
+    connects = []
+
+    def connect(host, port, auth):
+        connects.append(clock.now)
+        if len(connects) == 1:
+            raise IOError('connection refused')
+    xmpp_conn.connect.side_effect = connect
+    loop, clock = job_loop(cups, cpp, xmpp_conn, monkeypatch)
+
+    while len(connects) < 2:
+        loop.timers.run_once()
+
+    assert connects[0] == 0
+    assert 0 < connects[1] <= cloudprint.FAIL_RETRY_MIN
+    # we poll for the jobs whose notifications we missed
+    assert cpp.fetch_jobs.call_count == 2
+
+
+def test_job_loop_reconnects_after_drop(cups, cpp, xmpp_conn, monkeypatch):
+    cpp.test_add_printer('printer').get_jobs.return_value = []
+    connected = [True]
+    xmpp_conn.is_connected.side_effect = lambda: connected[0]
+    connects = []
+
+    def connect(host, port, auth):
+        connects.append(clock.now)
+        connected[0] = True
+    xmpp_conn.connect.side_effect = connect
+    loop, clock = job_loop(cups, cpp, xmpp_conn, monkeypatch)
+
+    loop.timers.run_once()
+    # the connection drops while no-one is awaiting a notification
+    connected[0] = False
+    dropped = clock.now
+    while len(connects) < 2 and clock.now < dropped + 3600:
+        loop.timers.run_once()
+
+    assert len(connects) == 2
+    assert connects[0] == 0
+    assert 0 < connects[1] - dropped <= cloudprint.FAIL_RETRY_MIN
+    assert cpp.fetch_jobs.call_count == 2
+
+
+def test_job_loop_retry_after_sweep(cups, cpp, xmpp_conn, monkeypatch):
+    printer = cpp.test_add_printer('printer')
+    job = {'id': 'job_1', 'title': 'title'}
+    printer.get_jobs.return_value = [job]
+    released = threading.Event()
+    attempts = []
+
+    def handler(connection, printer, job):
+        attempts.append(clock.now)
+        if len(attempts) == 1:
+            # fail once the sweep which submitted us has returned
+            released.wait()
+            cpp.retries.failed(printer, job, IOError('connection reset'))
+        else:
+            cpp.retries.succeeded(job['id'])
+    dispatcher = jobs.JobDispatcher(handler, mock.Mock)
+
+    loop, clock = job_loop(cups, cpp, xmpp_conn, monkeypatch,
+                           dispatcher=dispatcher)
+    cpp.retries = retry.RetryQueue(
+        cloudprint.RETRIES,
+        retry.Backoff(5, 5, jitter=0),
+        clock=clock,
+        on_failed=loop.wake,
+    )
+
+    def await_notification(timeout):
+        # time stands still while jobs run
+        dispatcher.wait()
+        clock.sleep(timeout)
+    xmpp_conn.await_notification.side_effect = await_notification
+
+    loop.timers.run_pending()
+    released.set()
+    dispatcher.wait()
+    while len(attempts) < 2 and clock.now < 3600:
+        loop.timers.run_once()
+
+    assert attempts == [0, 5]
+    dispatcher.shutdown()
+
+
+def test_job_deadline(requests, cups, cpp):
+    cpp.job_deadline = 0.001
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = [{
+        'fileUrl': 'http://print_job.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': 'title',
+        'id': 'job_1',
+        'ownerId': 'owner@example.com'
+    }]
+
+    def slow_document(request, context):
+        time.sleep(0.01)
+        return b'1234'
+    requests.get('http://print_job.pdf', content=slow_document)
+    requests.get('http://ticket', json={})
+
+    cloudprint.sweep_jobs(cups, cpp)
+
+    assert 'job_1' in cpp.retries
+    assert not cpp.finish_job.called
+    assert not cups.finishDocument.called
+
+
+def test_pending_ack_not_reprinted(requests, cups, cpp, tmpdir):
+    cpp.acks = acks.AckQueue(str(tmpdir.join('acks')), mock.Mock())
+    cpp.acks.put('job_1', 'DONE')
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = [{
+        'fileUrl': 'http://print_job.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': 'title',
+        'id': 'job_1',
+        'ownerId': 'owner@example.com'
+    }]
+
+    cloudprint.sweep_jobs(cups, cpp)
+
+    assert not requests.called
+    assert not cups.createJob.called
+
+
+def test_ticket_workers():
+    try:
+        cloudprint.set_ticket_workers(8)
+        assert cloudprint.ticket_pool()._max_workers == 8
+    finally:
+        cloudprint.set_ticket_workers(cloudprint.JOB_WORKERS)
+    assert cloudprint.ticket_pool()._max_workers == cloudprint.JOB_WORKERS
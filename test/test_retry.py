@@ -0,0 +1,132 @@
+import mock
+import requests
+
+from cloudprint import retry
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(response=response)
+
+
+def test_backoff():
+    backoff = retry.Backoff(1, 10, jitter=0)
+
+    assert [backoff.next() for _ in range(6)] == [1, 2, 4, 8, 10, 10]
+
+    backoff.reset()
+
+    assert backoff.next() == 1
+
+
+def test_backoff_jitter():
+    backoff = retry.Backoff(8, 60, jitter=0.5, random=lambda: 1.0)
+
+    assert backoff.delay(0) == 4
+    assert backoff.delay(1) == 8
+
+
+def test_is_transient():
+    assert retry.is_transient(requests.Timeout())
+    assert retry.is_transient(requests.ConnectionError())
+    assert retry.is_transient(http_error(503))
+    assert not retry.is_transient(http_error(404))
+    assert not retry.is_transient(ValueError(), permanent=(ValueError,))
+
+
+def test_retry_queue():
+    clock = Clock()
+    queue = retry.RetryQueue(2, retry.Backoff(10, 100, jitter=0), clock=clock)
+    printer = mock.Mock(name='printer')
+    job = {'id': 'job_1'}
+
+    assert queue.failed(printer, job, Exception()) == 10
+    assert 'job_1' in queue
+    assert queue.next_delay() == 10
+    assert queue.pop_due() == []
+
+    clock.now += 10
+    assert queue.pop_due() == [(printer, job)]
+    assert queue.next_delay() is None
+    assert 'job_1' in queue
+
+    assert queue.failed(printer, job, Exception()) == 20
+    clock.now += 20
+    assert queue.pop_due() == [(printer, job)]
+
+    assert queue.failed(printer, job, Exception()) is None
+    assert 'job_1' not in queue
+
+
+def test_retry_queue_rearm():
+    clock = Clock()
+    queue = retry.RetryQueue(2, retry.Backoff(10, 100, jitter=0), clock=clock)
+    printer = mock.Mock(name='printer')
+    job = {'id': 'job_1'}
+
+    queue.failed(printer, job, Exception())
+    clock.now += 10
+    assert queue.pop_due() == [(printer, job)]
+
+    queue.rearm('job_1')
+    assert queue.next_delay() == 10
+    clock.now += 10
+    assert queue.pop_due() == [(printer, job)]
+
+    # a job which is due already, or gone, is left alone
+    queue.rearm('job_2')
+    assert 'job_2' not in queue
+
+
+def test_retry_queue_independent_jobs():
+    clock = Clock()
+    queue = retry.RetryQueue(1, retry.Backoff(10, 100, jitter=0), clock=clock)
+    printer = mock.Mock(name='printer')
+
+    assert queue.failed(printer, {'id': 'job_1'}, Exception()) == 10
+    assert queue.failed(printer, {'id': 'job_2'}, Exception()) == 10
+
+    queue.succeeded('job_1')
+
+    assert 'job_1' not in queue
+    assert 'job_2' in queue
+
+
+def test_retry_queue_permanent():
+    queue = retry.RetryQueue(
+        5,
+        retry.Backoff(10, 100),
+        permanent=(ValueError,),
+    )
+
+    assert queue.failed(mock.Mock(), {'id': 'job_1'}, ValueError()) is None
+    assert 'job_1' not in queue
+
+
+def test_retry_queue_on_failed():
+    on_failed = mock.Mock(name='on_failed')
+    queue = retry.RetryQueue(
+        1,
+        retry.Backoff(10, 100),
+        permanent=(ValueError,),
+        on_failed=on_failed,
+    )
+
+    queue.failed(mock.Mock(), {'id': 'job_1'}, ValueError())
+    assert not on_failed.called
+
+    queue.failed(mock.Mock(), {'id': 'job_2'}, IOError())
+    on_failed.assert_called_once_with()
+
+    # out of retries
+    queue.failed(mock.Mock(), {'id': 'job_2'}, IOError())
+    on_failed.assert_called_once_with()
@@ -0,0 +1,122 @@
+from cloudprint import scheduler
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.waits = []
+
+    def __call__(self):
+        return self.now
+
+    def wait(self, timeout):
+        self.waits.append(timeout)
+        self.now += timeout
+
+
+def test_runs_in_deadline_order():
+    clock = Clock()
+    timers = scheduler.Scheduler(clock.wait, clock)
+    ran = []
+
+    timers.call_later(5, lambda: ran.append(('b', clock.now)))
+    timers.call_later(2, lambda: ran.append(('a', clock.now)))
+    timers.call_later(5, lambda: ran.append(('c', clock.now)))
+    timers.run()
+
+    assert ran == [('a', 1002.0), ('b', 1005.0), ('c', 1005.0)]
+    assert clock.waits == [2.0, 3.0]
+
+
+def test_wakes_at_next_deadline():
+    clock = Clock()
+    timers = scheduler.Scheduler(clock.wait, clock)
+    timers.call_at(1010.0, lambda: None)
+
+    timers.run_once()
+
+    assert clock.waits == [10.0]
+
+
+def test_cancel():
+    clock = Clock()
+    timers = scheduler.Scheduler(clock.wait, clock)
+    ran = []
+
+    timer = timers.call_later(1, lambda: ran.append('cancelled'))
+    timers.call_later(3, lambda: ran.append('kept'))
+    timer.cancel()
+    timers.run()
+
+    assert ran == ['kept']
+    assert clock.waits == [3.0]
+
+
+def test_repeating_task():
+    clock = Clock()
+    timers = scheduler.Scheduler(clock.wait, clock)
+    ran = []
+
+    def tick():
+        ran.append(clock.now)
+        if len(ran) < 3:
+            timers.call_later(10, tick)
+    timers.call_later(0, tick)
+    timers.run()
+
+    assert ran == [1000.0, 1010.0, 1020.0]
+
+
+def test_failing_task():
+    clock = Clock()
+    timers = scheduler.Scheduler(clock.wait, clock)
+    ran = []
+
+    def fail():
+        raise Exception('failed')
+    timers.call_later(1, fail)
+    timers.call_later(1, lambda: ran.append('after'))
+    timers.run()
+
+    assert ran == ['after']
+
+
+def test_wait_can_schedule():
+    clock = Clock()
+    ran = []
+
+    def wait(timeout):
+        if not ran:
+            # e.g. a notification arriving half way to the deadline
+            clock.now += timeout / 2
+            timers.call_later(0, lambda: ran.append(clock.now))
+        else:
+            clock.now += timeout
+    timers = scheduler.Scheduler(wait, clock)
+    timers.call_later(10, lambda: ran.append(clock.now))
+    timers.run()
+
+    assert ran == [1005.0, 1010.0]
+
+
+def test_watch():
+    clock = Clock()
+    watched = []
+
+    class Watch(object):
+        def __init__(self, name):
+            self.name = name
+
+        def __enter__(self):
+            watched.append(self.name)
+
+        def __exit__(self, *exc_info):
+            return False
+    timers = scheduler.Scheduler(clock.wait, clock, Watch)
+
+    def task():
+        assert len(watched) == 1
+    timers.call_later(1, task)
+    timers.run()
+
+    assert 'task' in watched[0]
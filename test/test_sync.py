@@ -1,6 +1,8 @@
 import mock
 
 from cloudprint import cloudprint
+from cloudprint import ppdcache
+from cloudprint.printerfilter import PrinterFilter
 
 
 def test_get_printer_info(tmpdir):
@@ -20,6 +22,42 @@ def test_get_printer_info(tmpdir):
 
     cups.getPPD.assert_called_with('foo')
     cups.getPrinterAttributes.assert_called_with('foo')
+    assert not ppd_path.exists()
+
+
+def test_get_printer_info_cached(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        cloudprint,
+        'PPD_CACHE',
+        ppdcache.PPDCache(cloudprint.PPD_CACHE_SIZE),
+    )
+
+    def get_ppd(name):
+        ppd_path = tmpdir.join('ppd')
+        ppd_path.write('this is a ppd')
+        return str(ppd_path)
+
+    cups = mock.Mock(name='cups')
+    cups.getPPD.side_effect = get_ppd
+    cups.getPrinterAttributes.return_value = {
+        'printer-info': mock.sentinel.desc,
+        'printer-state-change-time': 1234,
+    }
+
+    assert cloudprint.get_printer_info(cups, 'foo') == (
+        'this is a ppd',
+        mock.sentinel.desc,
+    )
+    assert cloudprint.get_printer_info(cups, 'foo') == (
+        'this is a ppd',
+        mock.sentinel.desc,
+    )
+    assert cups.getPPD.call_count == 1
+
+    cups.getPrinterAttributes.return_value['printer-state-change-time'] = 1235
+
+    cloudprint.get_printer_info(cups, 'foo')
+    assert cups.getPPD.call_count == 2
 
 
 def test_sync_add_printer(cups, cpp):
@@ -48,3 +86,119 @@ def test_sync_update_printer(cups, cpp):
         old_printer.description,
         old_printer.ppd,
     )
+
+
+def test_sync_unchanged_printer(cups, cpp):
+    cups.test_add_printer('old')
+    old_printer = cpp.test_add_printer('old')
+    old_printer.is_current.return_value = True
+
+    cloudprint.sync_printers(cups, cpp)
+
+    old_printer.is_current.assert_called_with(
+        old_printer.description,
+        old_printer.ppd,
+    )
+    assert not old_printer.update.called
+
+
+def test_sync_parallel(cups, cpp):
+    for name in ('new 1', 'new 2', 'old'):
+        cups.test_add_printer(name)
+    old_printer = cpp.test_add_printer('old')
+    gone_printer = cpp.test_add_printer('gone')
+
+    failures = cloudprint.sync_printers(cups, cpp, workers=4)
+
+    assert failures == []
+    cpp.add_printer.assert_any_call('new 1', mock.ANY, mock.ANY)
+    cpp.add_printer.assert_any_call('new 2', mock.ANY, mock.ANY)
+    assert old_printer.update.called
+    gone_printer.delete.assert_called_with()
+
+
+def test_sync_failures(cups, cpp):
+    cups.test_add_printer('old')
+    cups.test_add_printer('new')
+    old_printer = cpp.test_add_printer('old')
+    error = Exception('update failed')
+    old_printer.update.side_effect = error
+
+    failures = cloudprint.sync_printers(cups, cpp, workers=4)
+
+    assert failures == [('old', error)]
+    cpp.add_printer.assert_called_with('new', mock.ANY, mock.ANY)
+
+
+def test_sync_printer_names(cups, cpp):
+    cups.test_add_printer('new 1')
+    cups.test_add_printer('new 2')
+    old_printer = cpp.test_add_printer('old')
+
+    cloudprint.sync_printers(cups, cpp, printer_names=['new 2'])
+
+    cpp.add_printer.assert_called_once_with('new 2', mock.ANY, mock.ANY)
+    assert not old_printer.delete.called
+
+
+def test_watcher_notifications(cups, cpp):
+    cups.test_add_printer('new')
+    old_printer = cpp.test_add_printer('old')
+    cups.createSubscription.return_value = 7
+    cups.getNotifications.return_value = {
+        'notifications': [
+            {
+                'notify-sequence-number': 1,
+                'notify-subscribed-event': 'printer-added',
+                'printer-name': 'new',
+            },
+            {
+                'notify-sequence-number': 2,
+                'notify-subscribed-event': 'printer-deleted',
+                'printer-name': 'old',
+            },
+        ]
+    }
+
+    watcher = cloudprint.PrinterWatcher(cups, cpp)
+    watcher.start()
+
+    assert watcher.poll() == set(['new', 'old'])
+    cups.getNotifications.assert_called_with([7], [1])
+    cpp.add_printer.assert_called_with('new', mock.ANY, mock.ANY)
+    old_printer.delete.assert_called_with()
+
+    cups.getNotifications.return_value = {'notifications': []}
+
+    assert watcher.poll() == set()
+    cups.getNotifications.assert_called_with([7], [3])
+
+
+def test_watcher_diff(cups, cpp):
+    printers = {'old': {'printer-info': 'old printer'}}
+    cups.getPrinters.side_effect = lambda: dict(printers)
+    cups.createSubscription.side_effect = cloudprint.cups.IPPError(0, 'no')
+    old_printer = cpp.test_add_printer('old')
+
+    watcher = cloudprint.PrinterWatcher(cups, cpp)
+    watcher.start()
+
+    assert watcher.poll() == set()
+
+    printers['old'] = {'printer-info': 'renamed printer'}
+    printers['new'] = {'printer-info': 'new printer'}
+
+    assert watcher.poll() == set(['old', 'new'])
+    cpp.add_printer.assert_called_with('new', mock.ANY, mock.ANY)
+    assert old_printer.update.called
+
+
+def test_sync_filter(cups, cpp):
+    cups.test_add_printer('lp')
+    cups.test_add_printer('lp-skip')
+    cups.test_add_printer('other')
+    cpp.printer_filter = PrinterFilter(include=['lp'], exclude=['lp-skip'])
+
+    cloudprint.sync_printers(cups, cpp)
+
+    cpp.add_printer.assert_called_once_with('lp', mock.ANY, mock.ANY)
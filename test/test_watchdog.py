@@ -0,0 +1,73 @@
+import threading
+
+from cloudprint import watchdog
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def stuck_here(release):
+    release.wait(5)
+
+
+def test_overdue_task(caplog):
+    clock = Clock()
+    dog = watchdog.Watchdog(clock=clock)
+    release = threading.Event()
+    watching = threading.Event()
+
+    def task():
+        with dog.watch('stuck task', 10, recover=release.set):
+            watching.set()
+            stuck_here(release)
+    thread = threading.Thread(target=task)
+    thread.start()
+    watching.wait(5)
+
+    assert dog.check() == []
+
+    clock.now += 10
+    assert dog.check() == ['stuck task']
+    thread.join(5)
+    assert not thread.is_alive()
+    assert 'stuck_here' in caplog.text
+
+    # only reported once
+    assert dog.check() == []
+
+
+def test_finished_task():
+    clock = Clock()
+    dog = watchdog.Watchdog(timeout=10, clock=clock)
+
+    with dog.watch('quick task'):
+        pass
+    clock.now += 10
+
+    assert dog.check() == []
+
+
+def test_no_timeout():
+    clock = Clock()
+    dog = watchdog.Watchdog(clock=clock)
+
+    with dog.watch('task'):
+        clock.now += 3600
+        assert dog.check() == []
+
+
+def test_failed_recovery():
+    clock = Clock()
+
+    def recover():
+        raise Exception('recover failed')
+    dog = watchdog.Watchdog(timeout=10, recover=recover, clock=clock)
+
+    with dog.watch('task'):
+        clock.now += 10
+        assert dog.check() == ['task']
@@ -0,0 +1,227 @@
+import base64
+import os
+import socket
+import threading
+import time
+import tracemalloc
+
+from xml.etree.ElementTree import XMLParser
+
+import pytest
+
+from cloudprint import xmpp
+
+
+STREAM_START = (
+    '<stream:stream xmlns:stream="http://etherx.jabber.org/streams" '
+    'xmlns="jabber:client">'
+)
+
+
+def push(printer_id):
+    return (
+        '<message from="cloudprint.google.com">'
+        '<push:push channel="cloudprint.google.com" xmlns:push="google:push">'
+        '<push:recipient to="me"/>'
+        '<push:data>%s</push:data>'
+        '</push:push>'
+        '</message>'
+    ) % base64.b64encode(printer_id.encode('utf-8')).decode('ascii')
+
+
+def connection(*stanzas):
+    conn = xmpp.XmppConnection()
+    conn._handler = xmpp.XmppXmlHandler()
+    conn._xmlparser = XMLParser(target=conn._handler)
+    conn._xmlparser.feed(STREAM_START)
+    for stanza in stanzas:
+        conn._xmlparser.feed(stanza)
+    return conn
+
+
+def test_no_notification():
+    conn = connection()
+
+    assert conn._check_for_notification() is None
+
+
+def test_push_printer_ids():
+    conn = connection(
+        push('printer-1'),
+        '<iq type="result" id="7"/>',
+        push('printer-2'),
+        push('printer-1'),
+    )
+
+    assert conn._check_for_notification() == set(['printer-1', 'printer-2'])
+    assert conn._check_for_notification() is None
+
+
+def test_push_without_data():
+    conn = connection(
+        '<message><push:push xmlns:push="google:push"/></message>'
+    )
+
+    assert conn._check_for_notification() == set()
+
+
+def test_push_without_data_among_others():
+    conn = connection(
+        push('printer-1'),
+        '<message><push:push xmlns:push="google:push"/></message>',
+        push('printer-2'),
+    )
+
+    assert conn._check_for_notification() == set()
+
+
+def test_stream_end_ignored():
+    conn = connection('<iq type="result" id="1"/>', '</stream:stream>')
+
+    assert conn._handler.get_elem().tag == '{jabber:client}iq'
+    assert conn._handler.get_elem() is None
+
+
+def test_soak_memory():
+    """Feed a long-lived stream many stanzas, consuming them as we go, and
+    check that the memory held on to stays flat. Set
+    CLOUDPRINT_SOAK_STANZAS to a few million for a real soak run."""
+    total = int(os.environ.get('CLOUDPRINT_SOAK_STANZAS', 20000))
+    batch = 1000
+    stanzas = ''.join(
+        [push('printer-%d' % (i % 10)) for i in range(batch // 2)] +
+        ['<iq type="result" id="%d"/> ' % i for i in range(batch // 2)]
+    )
+
+    def feed():
+        conn._xmlparser.feed(stanzas)
+        assert conn._check_for_notification() == set(
+            'printer-%d' % i for i in range(10)
+        )
+
+    conn = connection()
+    # warm up caches and buffers before measuring
+    feed()
+
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        for _ in range(max(1, total // batch)):
+            feed()
+        growth = tracemalloc.get_traced_memory()[0] - baseline
+    finally:
+        tracemalloc.stop()
+
+    # a stanza which is kept costs hundreds of bytes
+    assert growth < 16 * max(total, batch)
+
+
+def socket_connection(recv_size=16):
+    conn = connection()
+    conn._wrappedsock, server = socket.socketpair()
+    conn._recv_size = recv_size
+    return conn, server
+
+
+def test_read_split_multibyte():
+    conn, server = socket_connection()
+    data = (
+        u'<message><body>café ☃</body></message>'
+    ).encode('utf-8')
+    split = data.index(u'☃'.encode('utf-8')) + 1
+
+    server.sendall(data[:split])
+    conn._read_socket()
+    server.sendall(data[split:])
+    conn._read_socket()
+
+    elem = conn._handler.get_elem()
+    assert elem[0].text == u'café ☃'
+
+
+def test_read_drains_socket():
+    conn, server = socket_connection(recv_size=16)
+
+    server.sendall(b''.join(
+        b'<iq type="result" id="%d"/>' % i for i in range(10)
+    ))
+    conn._read_socket()
+
+    ids = []
+    while True:
+        elem = conn._handler.get_elem()
+        if elem is None:
+            break
+        ids.append(elem.get('id'))
+    assert ids == [str(i) for i in range(10)]
+
+
+def test_read_closed():
+    conn, server = socket_connection()
+    conn._connected = True
+    server.close()
+
+    with pytest.raises(Exception):
+        conn._read_socket()
+    assert not conn.is_connected()
+
+
+def test_ssl_context_shared():
+    # Resuming TLS sessions needs every connection to use the same context
+    assert xmpp.ssl_context() is xmpp.ssl_context()
+
+
+def test_ping_unanswered():
+    conn, server = socket_connection()
+    conn._connected = True
+    conn._ping_timeout = 0.05
+    conn._nextping = 0
+
+    with pytest.raises(Exception):
+        conn.await_notification(5)
+    assert b'urn:xmpp:ping' in server.recv(4096)
+    assert not conn.is_connected()
+
+
+def test_ping_answered():
+    conn, server = socket_connection()
+    conn._connected = True
+    conn._ping_timeout = 1
+    conn._nextping = 0
+
+    def answer():
+        assert b'urn:xmpp:ping' in server.recv(4096)
+        server.sendall(b'<iq type="result" id="ping-1"/>')
+    thread = threading.Thread(target=answer)
+    thread.start()
+
+    assert conn.await_notification(1.5) is None
+    thread.join()
+    assert conn.is_connected()
+    assert conn._ping_deadline is None
+
+
+def test_wake():
+    conn, server = socket_connection()
+    conn._connected = True
+
+    thread = threading.Thread(target=conn.wake)
+    thread.start()
+    thread.join()
+    start = time.time()
+
+    assert conn.await_notification(5) is None
+    assert time.time() - start < 1
+    assert conn.is_connected()
+
+    # the wakeup was used up
+    assert conn.await_notification(0.01) is None
+
+
+def test_tcp_keepalive():
+    sock = socket.socket()
+    try:
+        xmpp.set_tcp_keepalive(sock)
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+    finally:
+        sock.close()